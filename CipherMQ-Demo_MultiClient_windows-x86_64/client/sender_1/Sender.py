@@ -4,16 +4,37 @@ import time
 import ssl
 import sys
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler
+import queue
+import atexit
 from base64 import b64encode, b64decode
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
-from nacl.public import PrivateKey, PublicKey, SealedBox
 import os
+import argparse
+import random
+import mmap
+import struct
 import uuid
+import zlib
+import threading
+import contextlib
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from datetime import datetime, timezone
 
+# Configured by setup_logging() when run as a script; an embedding application configures it itself
+logger = logging.getLogger('Sender')
+
+# Optional: zstd compression, imported on first use; zlib is used when it is not installed
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
 # Custom filter for logging levels
 class LevelFilter(logging.Filter):
     def __init__(self, level):
@@ -23,17 +44,107 @@ class LevelFilter(logging.Filter):
     def filter(self, record):
         return record.levelno == self.level
 
-# Initialize logging
-def setup_logging(config):
+# Handlers whose per-record flush is skipped while the log writer is draining a batch
+class DeferredFlush:
+    deferred = False
+
+    def flush(self):
+        if not self.deferred:
+            super().flush()
+
+class BatchStreamHandler(DeferredFlush, logging.StreamHandler):
+    pass
+
+class BatchRotatingFileHandler(DeferredFlush, RotatingFileHandler):
+    pass
+
+# Hands records to the log writer thread; only the message is merged here, the rest of
+# the formatting and all file I/O happen off the event loop. When the queue is full, records
+# below ERROR are dropped rather than stalling the caller.
+class LogQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.ERROR:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Background thread that writes queued records in batches and flushes each handler once per batch
+class LogWriter:
+    def __init__(self, queue_handler, handlers, batch_size=256):
+        self.queue_handler = queue_handler
+        self.queue = queue_handler.queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.reported_drops = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            dropped = self.queue_handler.dropped
+            if dropped > self.reported_drops:
+                batch.append(logging.makeLogRecord({
+                    "name": "logging", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Log queue full, dropped {dropped - self.reported_drops} records"
+                }))
+                self.reported_drops = dropped
+            for handler in self.handlers:
+                handler.deferred = True
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.deferred = False
+                handler.flush()
+
+# Initialize logging; the console handler writes to stream
+def setup_logging(config, stream=None):
     logger = logging.getLogger('Sender')
     logger.setLevel(getattr(logging, config["logging"]["level"]))
+    # Queue mode: the calling thread only enqueues records, a writer thread does the I/O
+    queued = config["logging"].get("queue", False)
+    handlers = []
 
     # Console handler
-    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler = BatchStreamHandler(stream or sys.stdout)
     console_handler.setFormatter(logging.Formatter(
         '%(asctime)s [%(levelname)s] %(message)s'
     ))
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
 
     # File handlers for different log levels
     for level, file_path in [
@@ -41,7 +152,7 @@ def setup_logging(config):
         (logging.DEBUG, config["logging"]["debug_file_path"]),
         (logging.ERROR, config["logging"]["error_file_path"])
     ]:
-        handler = RotatingFileHandler(
+        handler = BatchRotatingFileHandler(
             file_path,
             maxBytes=config["logging"]["max_size_mb"] * 1_000_000,
             backupCount=5
@@ -51,12 +162,22 @@ def setup_logging(config):
         handler.setFormatter(logging.Formatter(
             '{"time": "%(asctime)s", "level": "%(levelname)s", "message": "%(message)s"}'
         ))
-        logger.addHandler(handler)
+        handlers.append(handler)
+
+    if queued:
+        queue_handler = LogQueueHandler(queue.Queue(config["logging"].get("queue_size", 10000)))
+        logger.addHandler(queue_handler)
+        LogWriter(queue_handler, handlers, config["logging"].get("batch_size", 256)).start()
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
 
 # Extract client_id from client certificate
 def extract_client_id(tls_config):
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
     try:
         with open(tls_config["client_cert_path"], "rb") as cert_file:
             cert_data = cert_file.read()
@@ -66,154 +187,757 @@ def extract_client_id(tls_config):
             raise ValueError("No Common Name found in client certificate")
         return cn[0].value
     except Exception as e:
-        print(f"❌ [SENDER] Error extracting client_id from certificate: {e}")
-        sys.exit(1)
+        raise ValueError(f"Error extracting client_id from certificate: {e}") from e
 
 # Load configuration
-try:
-    os.makedirs("logs", exist_ok=True)
-    os.makedirs("keys", exist_ok=True)
-    with open("config.json", "r") as config_file:
-        config = json.load(config_file)
-    EXCHANGE_NAME = config["exchange_name"]
-    BINDINGS = config.get("bindings", [])
-    SERVER_ADDRESS = config["server_address"]
-    SERVER_PORT = config["server_port"]
-    TLS_CONFIG = config["tls"]
-    RECEIVER_CLIENT_IDS = config.get("receiver_client_ids", ["receiver_1"])
-    if isinstance(RECEIVER_CLIENT_IDS, str):
-        RECEIVER_CLIENT_IDS = [RECEIVER_CLIENT_IDS]
-    CLIENT_ID = extract_client_id(TLS_CONFIG)
-    logger = setup_logging(config)
-    logger.info(f"Extracted client_id from certificate: {CLIENT_ID}")
-except FileNotFoundError:
-    print("❌ [SENDER] Configuration file 'config.json' not found.")
-    sys.exit(1)
-except KeyError as e:
-    print(f"❌ [SENDER] Missing key in configuration file: {e}")
-    sys.exit(1)
-
-# Stores pending messages until acknowledged
-pending_messages = {}
+def load_config(path="config.json"):
+    with open(path, "r") as config_file:
+        return json.load(config_file)
+
+# Bounded store of unacknowledged messages with memory accounting.
+# When full, producers either wait for ACKs to free space ("block") or are refused ("reject").
+# Permanently failed messages are kept for failed_ttl seconds and are the first to be evicted under pressure.
+class PendingStore:
+    def __init__(self, max_messages=10000, max_bytes=64_000_000, policy="block", failed_ttl=300):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.failed_ttl = failed_ttl
+        # message_id -> (message, size)
+        self._messages = {}
+        # message_id -> (message, size, failed_at), oldest first
+        self._failed = OrderedDict()
+        self._bytes = 0
+        self._waiters = []
+        self._stats = {"added": 0, "acked": 0, "failed": 0, "refused": 0, "evicted": 0, "expired": 0, "blocked": 0}
+
+    @staticmethod
+    def message_size(message: dict) -> int:
+        size = 256  # dict and id overhead
+        for value in message.values():
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            elif isinstance(value, dict):
+                size += sum(len(k) + len(v) for k, v in value.items())
+        return size
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __contains__(self, message_id):
+        return message_id in self._messages
+
+    def get(self, message_id):
+        entry = self._messages.get(message_id)
+        return entry[0] if entry else None
+
+    def _has_room(self, size):
+        return (len(self._messages) + len(self._failed) < self.max_messages
+                and self._bytes + size <= self.max_bytes)
+
+    def _drop_failed(self, now):
+        while self._failed:
+            message_id, (_, size, failed_at) = next(iter(self._failed.items()))
+            if now - failed_at < self.failed_ttl:
+                break
+            del self._failed[message_id]
+            self._bytes -= size
+            self._stats["expired"] += 1
+
+    def _evict_failed(self, size):
+        while self._failed and not self._has_room(size):
+            _, (_, failed_size, _) = self._failed.popitem(last=False)
+            self._bytes -= failed_size
+            self._stats["evicted"] += 1
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # Store a message until it is acknowledged; returns False if it was refused
+    async def add(self, message: dict) -> bool:
+        size = self.message_size(message)
+        while True:
+            self._drop_failed(time.monotonic())
+            self._evict_failed(size)
+            if self._has_room(size):
+                break
+            if self.policy == "reject" or not self._messages:
+                self._stats["refused"] += 1
+                logger.warning("Pending store full, refusing message %s: %s", message['message_id'], self.stats())
+                return False
+            self._stats["blocked"] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._messages[message['message_id']] = (message, size)
+        self._bytes += size
+        self._stats["added"] += 1
+        return True
+
+    def ack(self, message_id):
+        entry = self._messages.pop(message_id, None) or self._failed.pop(message_id, None)
+        if entry:
+            self._bytes -= entry[1]
+            self._stats["acked"] += 1
+            self._release()
+
+    # Move a message that exhausted its retries out of the in-flight set
+    def fail(self, message_id):
+        entry = self._messages.pop(message_id, None)
+        if entry:
+            self._failed[message_id] = (entry[0], entry[1], time.monotonic())
+            self._stats["failed"] += 1
+            self._drop_failed(time.monotonic())
+            self._release()
+
+    def failed_messages(self) -> list:
+        return [entry[0] for entry in self._failed.values()]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._messages),
+            "failed_held": len(self._failed),
+            "bytes": self._bytes,
+            "max_messages": self.max_messages,
+            "max_bytes": self.max_bytes,
+            **self._stats
+        }
+
+# Crash-safe, append-only log of unacknowledged messages.
+# Records are group-committed with one fsync per batch. A segment is deleted once it and every
+# older segment hold no unacknowledged publishes; the few survivors of old segments are carried forward.
+class Outbox:
+    RECORD_HEADER = struct.Struct(">cII")  # record type, payload length, crc32 of payload
+    PUBLISH = b"P"
+    ACK = b"A"
+
+    def __init__(self, path="outbox", segment_size=16_000_000, commit_interval=0.005, commit_max_records=256):
+        self.path = path
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.commit_max_records = commit_max_records
+        # message_id -> segment number holding its publish record
+        self._live = {}
+        # segment number -> [live message_ids, publish records written]
+        self._segments = {}
+        self._active = None
+        self._active_size = 0
+        self._file = None
+        # (encoded record, message_id of a publish or None) waiting for the next commit
+        self._buffer = []
+        self._waiters = []
+        self._wakeup = None
+        self._timer = None
+        self._committer = None
+        self._closing = False
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f"segment-{number:06d}.log")
+
+    def _encode(self, kind, payload: bytes) -> bytes:
+        return self.RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+    # Publish records hold the message as JSON, with its binary fields base64-encoded
+    @staticmethod
+    def _serialize(message: dict) -> bytes:
+        record = dict(message)
+        for field in BINARY_FIELDS:
+            if field in record:
+                record[field] = b64encode(record[field]).decode('utf-8')
+        if 'recipients' in record:
+            record['recipients'] = {rid: b64encode(key).decode('utf-8') for rid, key in record['recipients'].items()}
+        return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def _deserialize(payload: bytes) -> dict:
+        message = json.loads(payload)
+        for field in BINARY_FIELDS:
+            if field in message:
+                message[field] = b64decode(message[field])
+        if 'recipients' in message:
+            message['recipients'] = {rid: b64decode(key) for rid, key in message['recipients'].items()}
+        return message
+
+    def _read_segment(self, number):
+        with open(self._segment_path(number), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                try:
+                    offset = 0
+                    while offset + self.RECORD_HEADER.size <= len(data):
+                        kind, length, crc = self.RECORD_HEADER.unpack_from(data, offset)
+                        start = offset + self.RECORD_HEADER.size
+                        end = start + length
+                        if end > len(data) or zlib.crc32(view[start:end]) != crc:
+                            logger.warning(f"Outbox segment {number} has a torn record at offset {offset}, ignoring the rest")
+                            break
+                        yield kind, bytes(view[start:end])
+                        offset = end
+                finally:
+                    view.release()
+
+    # Replay every segment and return the unacknowledged messages in publish order
+    def recover(self) -> list:
+        os.makedirs(self.path, exist_ok=True)
+        numbers = sorted(
+            int(name[len("segment-"):-len(".log")]) for name in os.listdir(self.path)
+            if name.startswith("segment-") and name.endswith(".log")
+        )
+        messages = {}
+        for number in numbers:
+            self._segments[number] = [set(), 0]
+            for kind, payload in self._read_segment(number):
+                if kind == self.PUBLISH:
+                    message = self._deserialize(payload)
+                    message_id = message["message_id"]
+                    messages[message_id] = message
+                    self._move(message_id, number)
+                    self._segments[number][1] += 1
+                elif kind == self.ACK:
+                    message_id = payload.decode('utf-8')
+                    messages.pop(message_id, None)
+                    self._forget(message_id)
+
+        self._active = numbers[-1] + 1 if numbers else 1
+        self._segments[self._active] = [set(), 0]
+        self._file = open(self._segment_path(self._active), "ab")
+        self._delete_acknowledged_segments()
+        if messages:
+            logger.info(f"Recovered {len(messages)} unacknowledged messages from outbox")
+        return list(messages.values())
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._committer = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        if self._committer:
+            self._wakeup.set()
+            await self._committer
+        if self._file:
+            self._file.close()
+
+    def _move(self, message_id, number):
+        previous = self._live.get(message_id)
+        if previous is not None and previous in self._segments:
+            self._segments[previous][0].discard(message_id)
+        self._live[message_id] = number
+        self._segments[number][0].add(message_id)
+
+    def _forget(self, message_id) -> bool:
+        if message_id not in self._live:
+            return False
+        number = self._live.pop(message_id)
+        if number in self._segments:
+            self._segments[number][0].discard(message_id)
+        return True
+
+    def _schedule(self):
+        if len(self._buffer) >= self.commit_max_records:
+            self._wakeup.set()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.commit_interval, self._wakeup.set)
+
+    # Append a publish record; the returned future resolves once it is on disk
+    def append(self, message: dict) -> asyncio.Future:
+        payload = self._serialize(message)
+        self._buffer.append((self._encode(self.PUBLISH, payload), message['message_id']))
+        # Live from now on; the segment is assigned when the record is committed
+        self._live[message['message_id']] = None
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._schedule()
+        return waiter
+
+    # ACK records are committed with the next batch; nobody waits for them
+    def ack(self, message_id):
+        if not self._forget(message_id):
+            return
+        self._buffer.append((self._encode(self.ACK, message_id.encode('utf-8')), None))
+        self._schedule()
+
+    def _write_sync(self, data: bytes, rotate: bool):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if rotate:
+            self._file.close()
+            self._file = open(self._segment_path(self._active + 1), "ab")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                if self._closing:
+                    break
+                continue
+            records, self._buffer = self._buffer, []
+            waiters, self._waiters = self._waiters, []
+            data = b"".join(record for record, _ in records)
+            rotate = self._active_size + len(data) >= self.segment_size
+            try:
+                await loop.run_in_executor(None, self._write_sync, data, rotate)
+            except Exception as e:
+                logger.error(f"Outbox commit failed: {e}")
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for _, message_id in records:
+                if message_id is not None and message_id in self._live:
+                    self._move(message_id, self._active)
+                    self._segments[self._active][1] += 1
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            if rotate:
+                self._active += 1
+                self._active_size = 0
+                self._segments[self._active] = [set(), 0]
+            else:
+                self._active_size += len(data)
+            self._delete_acknowledged_segments()
+            self._carry_forward()
+            if self._closing and not self._buffer:
+                break
+
+    def _delete_acknowledged_segments(self):
+        for number in sorted(self._segments):
+            if number == self._active or self._segments[number][0]:
+                break
+            try:
+                os.remove(self._segment_path(number))
+            except FileNotFoundError:
+                pass
+            del self._segments[number]
+            logger.debug(f"Deleted acknowledged outbox segment {number}")
+
+    # Rewrite the few remaining live publishes of the oldest segment so it can be deleted
+    def _carry_forward(self):
+        oldest = min(self._segments)
+        live, written = self._segments[oldest]
+        if oldest == self._active or not live or len(live) * 10 > written:
+            return
+        for kind, payload in self._read_segment(oldest):
+            if kind == self.PUBLISH:
+                message_id = json.loads(payload)["message_id"]
+                if self._live.get(message_id) == oldest:
+                    self._buffer.append((self._encode(self.PUBLISH, payload), message_id))
+        logger.debug(f"Carrying {len(live)} live messages forward from outbox segment {oldest}")
+        self._schedule()
+
+# SSL context that offers the last session the server issued when opening a new connection,
+# so reconnects resume it instead of repeating the full mTLS handshake
+class ResumingSSLContext(ssl.SSLContext):
+    def __init__(self, protocol, resumption=True):
+        super().__init__()
+        self.resumption = resumption
+        # server_hostname -> ssl.SSLSession
+        self.sessions = {}
+        self.handshakes = {"full": 0, "resumed": 0, "full_ms": 0.0, "resumed_ms": 0.0}
+
+    # asyncio creates its SSLObject through wrap_bio, which is the only place a session can be injected
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and self.resumption and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    # TLS 1.3 session tickets arrive after the handshake, so call this once the server has sent data
+    def remember_session(self, writer, server_hostname="localhost"):
+        ssl_object = writer.get_extra_info('ssl_object')
+        session = ssl_object.session if ssl_object is not None else None
+        if session is not None and session.has_ticket:
+            self.sessions[server_hostname] = session
+
+    # Count the handshake of a newly opened connection; returns True if the session was resumed
+    def record_handshake(self, writer, seconds) -> bool:
+        ssl_object = writer.get_extra_info('ssl_object')
+        kind = "resumed" if ssl_object is not None and ssl_object.session_reused else "full"
+        self.handshakes[kind] += 1
+        self.handshakes[f"{kind}_ms"] = round(self.handshakes[f"{kind}_ms"] + seconds * 1000, 3)
+        return kind == "resumed"
 
 # Configure SSL context for mTLS
-ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-ssl_context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20')
-ssl_context.load_verify_locations(TLS_CONFIG["certificate_path"])
-ssl_context.load_cert_chain(
-    certfile=TLS_CONFIG["client_cert_path"],
-    keyfile=TLS_CONFIG["client_key_path"]
-)
-ssl_context.verify_mode = getattr(ssl, TLS_CONFIG["verify_mode"])
-ssl_context.check_hostname = TLS_CONFIG["check_hostname"]
-
-# Generate a message
-def generate_message():
+def create_ssl_context(tls_config):
+    ssl_context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT, tls_config.get("session_resumption", True))
+    ssl_context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20')
+    ssl_context.load_verify_locations(tls_config["certificate_path"])
+    ssl_context.load_cert_chain(
+        certfile=tls_config["client_cert_path"],
+        keyfile=tls_config["client_key_path"]
+    )
+    ssl_context.verify_mode = getattr(ssl, tls_config["verify_mode"])
+    ssl_context.check_hostname = tls_config["check_hostname"]
+    return ssl_context
+
+# Generate a message; content defaults to a sample text
+def generate_message(sender_id, size=None, content=None):
     correlation_id = str(uuid.uuid4())[:8]
-    current_time = datetime.now(timezone.utc).timestamp(),
+    current_time = datetime.now(timezone.utc).timestamp()
+    if content is None:
+        content = f"{sender_id}-CipherMQ Sample message with ID: {correlation_id}"
+    # Pad or trim the content to an exact payload size for load testing
+    if size is not None:
+        content = (content + " " + "x" * max(0, size - len(content) - 1))[:size]
     return {
         "correlation_id": correlation_id,
-        "sender_id": CLIENT_ID,
+        "sender_id": sender_id,
         "sent_timestamp": current_time,
-        "content": f"{CLIENT_ID}-CipherMQ Sample message with ID: {correlation_id}",
+        "content": content,
     }
 
-# Encrypt message for a receiver
-def encrypt_message(message, public_key_b64, receiver_client_id):
+# Resident cache of receiver public keys, their SealedBoxes and routing keys
+class PublicKeyring:
+    def __init__(self, key_dir="keys", bindings=None, recheck_interval=5.0):
+        self.key_dir = key_dir
+        self.recheck_interval = recheck_interval
+        self.routing_keys = {binding["queue_name"]: binding["routing_key"] for binding in bindings or []}
+        # receiver_client_id -> {"public_key_b64", "sealed_box", "routing_key", "mtime", "checked_at"}
+        self._entries = {}
+        # receiver_client_id -> time its key file was last found missing
+        self._missing = {}
+
+    def key_path(self, receiver_client_id):
+        return os.path.join(self.key_dir, f"{receiver_client_id}_public.key")
+
+    def routing_key_for(self, receiver_client_id):
+        return self.routing_keys.get(f"{receiver_client_id}_queue", f"{receiver_client_id}_key")
+
+    # Install a key; the SealedBox is only rebuilt when the key itself changed
+    def update(self, receiver_client_id, public_key_b64, mtime=None):
+        from nacl.public import PublicKey, SealedBox
+        entry = self._entries.get(receiver_client_id)
+        if entry is None or entry["public_key_b64"] != public_key_b64:
+            entry = {
+                "public_key_b64": public_key_b64,
+                "sealed_box": SealedBox(PublicKey(b64decode(public_key_b64))),
+                "routing_key": self.routing_key_for(receiver_client_id),
+            }
+            self._entries[receiver_client_id] = entry
+            logger.debug(f"Loaded public key for {receiver_client_id} into keyring")
+        self._missing.pop(receiver_client_id, None)
+        entry["mtime"] = mtime
+        entry["checked_at"] = time.monotonic()
+        return entry
+
+    # Look up a receiver; the key file is stat'ed at most once per recheck_interval
+    def get(self, receiver_client_id):
+        entry = self._entries.get(receiver_client_id)
+        now = time.monotonic()
+        if entry is not None and now - entry["checked_at"] < self.recheck_interval:
+            return entry
+        if entry is None and now - self._missing.get(receiver_client_id, -self.recheck_interval) < self.recheck_interval:
+            return None
+        path = self.key_path(receiver_client_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if entry is not None:
+                entry["checked_at"] = now
+            else:
+                self._missing[receiver_client_id] = now
+            return entry
+        if entry is not None and entry["mtime"] == mtime:
+            entry["checked_at"] = now
+            return entry
+        try:
+            with open(path, "r") as f:
+                public_key_b64 = f.read().strip()
+            return self.update(receiver_client_id, public_key_b64, mtime)
+        except Exception as e:
+            logger.error(f"Failed to load public key for {receiver_client_id} from {path}: {e}")
+            return entry
+
+    def __contains__(self, receiver_client_id):
+        return self.get(receiver_client_id) is not None
+
+    def known(self):
+        return list(self._entries)
+
+# Compresses message content before encryption; small or incompressible payloads are sent as-is.
+# The dictionary id is the crc32 of the dictionary bytes, so receivers can pick the matching one.
+class PayloadCompressor:
+    def __init__(self, algorithm="zlib", level=None, min_size=512, dictionary=None):
+        zstandard = import_zstandard() if algorithm == "zstd" else None
+        if algorithm == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, falling back to zlib compression")
+            algorithm = "zlib"
+        if algorithm not in ("zlib", "zstd"):
+            raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.level = level if level is not None else (3 if algorithm == "zstd" else 6)
+        self.min_size = min_size
+        self.dictionary = dictionary
+        self.dict_id = format(zlib.crc32(dictionary), '08x') if dictionary else None
+        self._zstandard = zstandard
+        self._zstd_dict = None
+        if algorithm == "zstd" and dictionary:
+            self._zstd_dict = zstandard.ZstdCompressionDict(dictionary)
+            self._zstd_dict.precompute_compress(level=self.level)
+        # zstd compressors are not thread-safe; each encryption worker gets its own
+        self._local = threading.local()
+
+    def _zstd_compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = self._zstandard.ZstdCompressor(level=self.level, dict_data=self._zstd_dict)
+        return compressor
+
+    # Returns (data, envelope fields); the fields are empty when the data was left uncompressed
+    def compress(self, data: bytes):
+        if len(data) < self.min_size:
+            return data, {}
+        if self.algorithm == "zstd":
+            compressed = self._zstd_compressor().compress(data)
+        elif self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+            compressed = compressor.compress(data) + compressor.flush()
+        else:
+            compressed = zlib.compress(data, self.level)
+        if len(compressed) >= len(data):
+            return data, {}
+        fields = {"compression": self.algorithm}
+        if self.dict_id:
+            fields["compression_dict"] = self.dict_id
+        return compressed, fields
+
+def load_compression_dictionary(path):
     try:
-        # 1. Decode public key
-        public_key = PublicKey(b64decode(public_key_b64))
-        sealed_box = SealedBox(public_key)
-
-        # 2. Generate session key and nonce
-        session_key = os.urandom(32)  # 32-byte session key
-        nonce = os.urandom(12)  # 12-byte nonce
-
-        # 3. Encrypt session key with sealed box
-        enc_session_key = sealed_box.encrypt(session_key)
-
-        # 4. Encrypt message with ChaCha20Poly1305
-        cipher = ChaCha20Poly1305(session_key)
-        message_bytes = message["content"].encode('utf-8')
-        ciphertext_with_tag = cipher.encrypt(nonce, message_bytes, None)
-
-        # 5. Generate message ID and timestamp
-        message_id = f"{message['sender_id']}-{message['correlation_id']}-{receiver_client_id}"
-        sent_time = datetime.now(timezone.utc).isoformat()
-
-        # 6. Construct encrypted message
-        encrypted_message = {
-            "message_id": message_id,
-            "receiver_client_id": receiver_client_id,
-            "enc_session_key": b64encode(enc_session_key).decode('utf-8'),
-            "nonce": b64encode(nonce).decode('utf-8'),
-            "ciphertext": b64encode(ciphertext_with_tag).decode('utf-8'),
-            "sent_time": sent_time
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.error(f"Failed to load compression dictionary {path}: {e}")
+        raise
+
+# Build a dictionary for small, similar payloads from sample files (one sample per line).
+# zstd dictionaries are trained; for zlib the most recent samples are used as raw dictionary content,
+# since deflate only looks back 32 KiB and prefers matches near the end of the dictionary.
+def train_compression_dictionary(sample_paths, size=16384, algorithm="zlib"):
+    samples = []
+    for path in sample_paths:
+        with open(path, "rb") as f:
+            samples.extend(line.rstrip(b"\n") for line in f if line.strip())
+    if not samples:
+        raise ValueError("No samples found")
+    zstandard = import_zstandard() if algorithm == "zstd" else None
+    if zstandard is not None:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    return b"".join(samples)[-min(size, 32768):]
+
+# Session keys sealed once per recipient set and reused with counter nonces until rotation
+class SessionKeyCache:
+    def __init__(self, rotate_after_messages=10000, rotate_after_seconds=300):
+        self.rotate_after_messages = rotate_after_messages
+        self.rotate_after_seconds = rotate_after_seconds
+        # tuple of receiver_client_ids -> session state
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self, targets, fingerprint):
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        session_key = os.urandom(32)
+        return {
+            "key_id": os.urandom(8).hex(),
+            "cipher": ChaCha20Poly1305(session_key),
+            "nonce_prefix": os.urandom(4),
+            "fingerprint": fingerprint,
+            "sealed_keys": {
+                receiver_client_id: sealed_box.encrypt(session_key)
+                for receiver_client_id, sealed_box, _ in targets
+            },
+            "counter": 0,
+            "created_at": time.monotonic()
         }
 
-        logger.debug(f"Hybrid encryption completed for {receiver_client_id}: "
-                     f"content_size={len(ciphertext_with_tag)}, "
-                     f"session_key_size={len(session_key)}")
-        return encrypted_message
+    # Returns (key_id, cipher, nonce, sealed_keys) for the next message to these targets
+    def next(self, targets):
+        recipients = tuple(target[0] for target in targets)
+        fingerprint = tuple(bytes(target[1]) for target in targets)
+        with self._lock:
+            session = self._sessions.get(recipients)
+            if (session is None
+                    or session["fingerprint"] != fingerprint
+                    or session["counter"] >= self.rotate_after_messages
+                    or time.monotonic() - session["created_at"] >= self.rotate_after_seconds):
+                session = self._sessions[recipients] = self._new_session(targets, fingerprint)
+                logger.info(f"New session key {session['key_id']} for {list(recipients)}")
+            session["counter"] += 1
+            nonce = session["nonce_prefix"] + session["counter"].to_bytes(8, 'big')
+        return session["key_id"], session["cipher"], nonce, session["sealed_keys"]
 
-    except Exception as e:
-        logger.error(f"Encryption failed for {receiver_client_id}: {e}")
-        return None
+# Hybrid encryption of messages for resolved (receiver_client_id, sealed_box, routing_key) targets.
+# Pure CPU work, safe to run on a worker pool; process pool workers build their own from the same settings.
+# Keys, nonces and ciphertexts stay raw bytes until a connection encodes them for the wire.
+class MessageEncryptor:
+    def __init__(self, multi_recipient=True, session_keys=False, session_rotate_messages=10000,
+                 session_rotate_seconds=300, compression=None):
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        self.settings = {
+            "multi_recipient": multi_recipient, "session_keys": session_keys,
+            "session_rotate_messages": session_rotate_messages, "session_rotate_seconds": session_rotate_seconds,
+            "compression": compression
+        }
+        self.multi_recipient = multi_recipient
+        self.use_session_keys = session_keys
+        self.session_keys = SessionKeyCache(session_rotate_messages, session_rotate_seconds)
+        # PayloadCompressor arguments, or None to send content uncompressed
+        self.compressor = PayloadCompressor(**compression) if compression else None
+        self._cipher = ChaCha20Poly1305
+
+    # Message content as bytes, compressed when enabled, plus the envelope fields describing it
+    def encode_content(self, message):
+        data = message["content"].encode('utf-8')
+        if self.compressor is None:
+            return data, {}
+        return self.compressor.compress(data)
+
+    # Encrypt message for a receiver
+    def encrypt_message(self, message, sealed_box, receiver_client_id):
+        try:
+            # 1. Generate session key and nonce
+            session_key = os.urandom(32)  # 32-byte session key
+            nonce = os.urandom(12)  # 12-byte nonce
+
+            # 2. Encrypt session key with sealed box
+            enc_session_key = sealed_box.encrypt(session_key)
+
+            # 3. Encrypt message with ChaCha20Poly1305
+            cipher = self._cipher(session_key)
+            message_bytes, compression = self.encode_content(message)
+            ciphertext_with_tag = cipher.encrypt(nonce, message_bytes, None)
+
+            # 4. Generate message ID and timestamp
+            message_id = f"{message['sender_id']}-{message['correlation_id']}-{receiver_client_id}"
+            sent_time = datetime.now(timezone.utc).isoformat()
+
+            # 5. Construct encrypted message
+            encrypted_message = {
+                "message_id": message_id,
+                "receiver_client_id": receiver_client_id,
+                "enc_session_key": enc_session_key,
+                "nonce": nonce,
+                "ciphertext": ciphertext_with_tag,
+                "sent_time": sent_time,
+                "sent_timestamp": message["sent_timestamp"]
+            }
+            encrypted_message.update(compression)
+
+            logger.debug("Hybrid encryption completed for %s: content_size=%d, session_key_size=%d",
+                         receiver_client_id, len(ciphertext_with_tag), len(session_key))
+            return encrypted_message
+
+        except Exception as e:
+            logger.error(f"Encryption failed for {receiver_client_id}: {e}")
+            return None
+
+    # Encrypt message content once and seal its session key for every target
+    def encrypt_envelope(self, message, targets):
+        try:
+            if self.use_session_keys:
+                key_id, cipher, nonce, sealed_keys = self.session_keys.next(targets)
+            else:
+                key_id = None
+                session_key = os.urandom(32)
+                nonce = os.urandom(12)
+                cipher = self._cipher(session_key)
+                # Only the 32-byte session key is sealed per receiver
+                sealed_keys = {
+                    receiver_client_id: sealed_box.encrypt(session_key)
+                    for receiver_client_id, sealed_box, _ in targets
+                }
+
+            content, compression = self.encode_content(message)
+            ciphertext_with_tag = cipher.encrypt(nonce, content, None)
+            envelope = {
+                "nonce": nonce,
+                "ciphertext": ciphertext_with_tag,
+                "sent_time": datetime.now(timezone.utc).isoformat(),
+                "sealed_keys": sealed_keys,
+                "key_id": key_id,
+                "compression": compression
+            }
 
-# Encrypt message for all receivers
-async def encrypt_message_for_receivers(message: dict, receiver_client_ids: list):
-    encrypted_messages = []
-    routing_keys = {binding["queue_name"]: binding["routing_key"] for binding in BINDINGS}
-    for receiver_client_id in receiver_client_ids:
-        public_key_path = f"keys/{receiver_client_id}_public.key"
-        if not os.path.exists(public_key_path):
-            logger.error(f"Public key for {receiver_client_id} not found")
-            continue
-        with open(public_key_path, "r") as f:
-            public_key_b64 = f.read().strip()
-        queue_suffix = receiver_client_id
-        queue_name = f"{queue_suffix}_queue"
-        routing_key = routing_keys.get(queue_name, f"{queue_suffix}_key")
-        encrypted_message = encrypt_message(message, public_key_b64, receiver_client_id)
-        if encrypted_message:
-            encrypted_message['routing_key'] = routing_key
+            logger.debug("Multi-recipient encryption completed: content_size=%d, recipients=%d",
+                         len(ciphertext_with_tag), len(sealed_keys))
+            return envelope
+
+        except Exception as e:
+            logger.error(f"Encryption failed for {[target[0] for target in targets]}: {e}")
+            return None
+
+    # Encrypt message for resolved targets
+    def encrypt_for_targets(self, message: dict, targets: list) -> list:
+        if self.multi_recipient and len(targets) > 1:
+            return self.encrypt_multi_recipient(message, targets)
+        if self.use_session_keys:
+            return [encrypted_message for target in targets for encrypted_message in self.encrypt_multi_recipient(message, [target])]
+        encrypted_messages = []
+        for receiver_client_id, sealed_box, routing_key in targets:
+            encrypted_message = self.encrypt_message(message, sealed_box, receiver_client_id)
+            if encrypted_message:
+                encrypted_message['routing_key'] = routing_key
+                encrypted_messages.append(encrypted_message)
+                logger.info("Encrypted message %s for %s with routing_key %s", encrypted_message['message_id'], receiver_client_id, routing_key)
+        return encrypted_messages
+
+    # One shared ciphertext for all targets, published once per routing key.
+    # Receivers sharing a routing key get a single message that carries a sealed key for each of them.
+    def encrypt_multi_recipient(self, message: dict, targets: list) -> list:
+        envelope = self.encrypt_envelope(message, targets)
+        if envelope is None:
+            return []
+        groups = {}
+        for receiver_client_id, _, routing_key in targets:
+            groups.setdefault(routing_key, []).append(receiver_client_id)
+
+        encrypted_messages = []
+        for routing_key, receiver_client_ids in groups.items():
+            receiver_client_id = receiver_client_ids[0]
+            suffix = receiver_client_id if len(receiver_client_ids) == 1 else routing_key
+            encrypted_message = {
+                "message_id": f"{message['sender_id']}-{message['correlation_id']}-{suffix}",
+                "receiver_client_id": receiver_client_id,
+                "enc_session_key": envelope["sealed_keys"][receiver_client_id],
+                "nonce": envelope["nonce"],
+                "ciphertext": envelope["ciphertext"],
+                "sent_time": envelope["sent_time"],
+                "sent_timestamp": message["sent_timestamp"],
+                "routing_key": routing_key
+            }
+            if envelope["key_id"]:
+                encrypted_message["key_id"] = envelope["key_id"]
+            encrypted_message.update(envelope["compression"])
+            if len(receiver_client_ids) > 1:
+                encrypted_message["recipients"] = {rid: envelope["sealed_keys"][rid] for rid in receiver_client_ids}
             encrypted_messages.append(encrypted_message)
-            pending_messages[encrypted_message['message_id']] = encrypted_message
-            logger.info(f"Encrypted message {encrypted_message['message_id']} for {receiver_client_id} with routing_key {routing_key}")
-    return encrypted_messages
-
-# Configure server with queue, exchange, and bindings
-async def configure_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    for binding in BINDINGS:
-        queue_name = binding["queue_name"]
-        exchange_name = binding["exchange_name"]
-        routing_key = binding["routing_key"]
-        command = f"declare_queue {queue_name}\n"
-        logger.debug(f"Sending command: {command.strip()}")
-        writer.write(command.encode('utf-8'))
-        await writer.drain()
-        response = (await reader.readline()).decode('utf-8').strip()
-        logger.info(f"Server response for queue declaration: {response}")
-        command = f"declare_exchange {exchange_name}\n"
-        logger.debug(f"Sending command: {command.strip()}")
-        writer.write(command.encode('utf-8'))
-        await writer.drain()
-        response = (await reader.readline()).decode('utf-8').strip()
-        logger.info(f"Server response for exchange declaration: {response}")
-        command = f"bind {queue_name} {exchange_name} {routing_key}\n"
-        logger.debug(f"Sending command: {command.strip()}")
-        writer.write(command.encode('utf-8'))
-        await writer.drain()
-        response = (await reader.readline()).decode('utf-8').strip()
-        logger.info(f"Server response for binding: {response}")
+            logger.info("Encrypted message %s for %s with routing_key %s", encrypted_message['message_id'], receiver_client_ids, routing_key)
+        return encrypted_messages
 
-# Get public key from server
-async def get_public_key(reader, writer, client_id):
-    command = f"get_public_key {client_id}\n"
-    logger.debug(f"Sending command: {command.strip()}")
-    writer.write(command.encode('utf-8'))
-    await writer.drain()
-    response = (await reader.readline()).decode('utf-8').strip()
+# Encryptor of a process pool worker, built once per worker process
+worker_encryptor = None
+
+def init_encrypt_worker(settings):
+    global worker_encryptor
+    worker_encryptor = MessageEncryptor(**settings)
+
+def encrypt_in_worker(message: dict, targets: list) -> list:
+    return worker_encryptor.encrypt_for_targets(message, targets)
+
+TOPOLOGY_LABELS = {"declare_queue": "queue declaration", "declare_exchange": "exchange declaration", "bind": "binding"}
+
+# Parse a get_public_key response
+def parse_public_key_response(client_id, response):
     if response.startswith("Public key: "):
         return response.split("Public key: ", 1)[1]
     elif response == "Public key not found":
@@ -223,198 +947,1591 @@ async def get_public_key(reader, writer, client_id):
         logger.error(f"Error getting public key: {response}")
         return None
 
-# Fetch public keys for all receivers and save to files
-async def fetch_all_public_keys():
-    public_keys = {}
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(SERVER_ADDRESS, SERVER_PORT, ssl=ssl_context, server_hostname="localhost"),
-                timeout=120.0
-            )
-            logger.info(f"TLS connection established for fetching public keys. Cipher: {writer.get_extra_info('cipher')}")
-            await configure_server(reader, writer)
-            for receiver_client_id in RECEIVER_CLIENT_IDS:
-                public_key = await get_public_key(reader, writer, receiver_client_id)
-                if public_key:
-                    public_keys[receiver_client_id] = public_key
-                    public_key_path = f"keys/{receiver_client_id}_public.key"
-                    try:
-                        with open(public_key_path, "w") as f:
-                            f.write(public_key)
-                        logger.info(f"Saved public key for {receiver_client_id} to {public_key_path}")
-                    except Exception as e:
-                        logger.error(f"Failed to save public key for {receiver_client_id}: {e}")
-                else:
-                    logger.warning(f"Skipping {receiver_client_id} due to missing public key")
-            writer.close()
-            await writer.wait_closed()
-            return public_keys
-        except asyncio.TimeoutError:
-            logger.warning(f"Timeout on attempt {attempt + 1}/{max_retries}, retrying in {2 ** attempt} seconds")
+# Get public key from server
+async def get_public_key(reader, writer, client_id):
+    command = f"get_public_key {client_id}\n"
+    logger.debug("Sending command: %s", command.strip())
+    writer.write(command.encode('utf-8'))
+    await writer.drain()
+    response = (await reader.readline()).decode('utf-8').strip()
+    return parse_public_key_response(client_id, response)
+
+# Resolves receiver public keys over one long-lived connection.
+# Lookups queued in the same loop iteration go out as one pipelined batch, concurrent lookups
+# for the same receiver share a request, and known keys are refreshed in the background.
+class KeyDirectory:
+    def __init__(self, producer, refresh_interval=300, negative_ttl=30):
+        self.producer = producer
+        self.keyring = producer.keyring
+        self.refresh_interval = refresh_interval
+        self.negative_ttl = negative_ttl
+        self.reader = None
+        self.writer = None
+        # receiver_client_id -> future of the request in flight
+        self._lookups = {}
+        self._queued = []
+        self._flush_scheduled = False
+        # receiver_client_id -> time the server last said it has no key
+        self._not_found = {}
+        self._io_lock = None
+        self._refresh_task = None
+        # Running lookup flushes; the event loop only keeps weak references to tasks
+        self._flushes = set()
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, max_retries=3):
+        for attempt in range(max_retries):
+            try:
+                self.reader, self.writer, _ = await self.producer.open_connection("fetching public keys")
+                return True
+            except asyncio.TimeoutError:
+                logger.warning(f"Timeout on attempt {attempt + 1}/{max_retries}, retrying in {2 ** attempt} seconds")
+            except Exception as e:
+                logger.error(f"Failed to connect for public keys on attempt {attempt + 1}/{max_retries}: {e}")
+            self.writer = None
             await asyncio.sleep(2 ** attempt)
+        return False
+
+    def start(self):
+        if self._refresh_task is None and self.refresh_interval:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self.connected:
+            self.writer.close()
+            await self.writer.wait_closed()
+        self.writer = None
+
+    # Future resolving to the receiver's base64 public key, or None
+    def lookup(self, receiver_client_id) -> asyncio.Future:
+        future = self._lookups.get(receiver_client_id)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        not_found_at = self._not_found.get(receiver_client_id)
+        if not_found_at is not None and time.monotonic() - not_found_at < self.negative_ttl:
+            future.set_result(None)
+            return future
+        self._lookups[receiver_client_id] = future
+        self._queued.append(receiver_client_id)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._start_flush)
+        return future
+
+    def _start_flush(self):
+        flush = asyncio.ensure_future(self._flush())
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+
+    # Resolve several receivers at once; returns {receiver_client_id: public_key_b64} for those found
+    async def resolve(self, receiver_client_ids) -> dict:
+        receiver_client_ids = list(receiver_client_ids)
+        public_keys = await asyncio.gather(*(self.lookup(receiver_client_id) for receiver_client_id in receiver_client_ids))
+        return {
+            receiver_client_id: public_key
+            for receiver_client_id, public_key in zip(receiver_client_ids, public_keys) if public_key
+        }
+
+    # Borrow the connection for request/response commands; lookups wait until it is returned
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        async with self._io_lock:
+            if not self.connected and not await self.connect():
+                raise ConnectionError("No connection to the server")
+            try:
+                yield self.reader, self.writer
+            except BaseException:
+                # Responses may now be out of step with requests, so start over with a new connection
+                if self.writer is not None:
+                    self.writer.close()
+                self.writer = None
+                raise
+
+    # Round trip on the existing connection; any answer to a key lookup shows the server is serving
+    async def ping(self, timeout=10.0) -> bool:
+        async with self.connection() as (reader, writer):
+            writer.write(f"get_public_key {self.producer.client_id}\n".encode('utf-8'))
+            await writer.drain()
+            return bool(await asyncio.wait_for(reader.readline(), timeout))
+
+    async def _flush(self):
+        self._flush_scheduled = False
+        batch, self._queued = self._queued, []
+        if not batch:
+            return
+        try:
+            async with self.connection() as (reader, writer):
+                logger.debug(f"Requesting public keys for {batch}")
+                writer.write("".join(f"get_public_key {receiver_client_id}\n" for receiver_client_id in batch).encode('utf-8'))
+                await writer.drain()
+                for receiver_client_id in batch:
+                    line = await reader.readline()
+                    if not line:
+                        raise ConnectionError("Connection closed by server")
+                    response = line.decode('utf-8').strip()
+                    self._complete(receiver_client_id, parse_public_key_response(receiver_client_id, response))
+                self.producer.ssl_context.remember_session(writer)
         except Exception as e:
-            logger.error(f"Failed to fetch public keys on attempt {attempt + 1}/{max_retries}: {e}")
-            await asyncio.sleep(2 ** attempt)
-    logger.error("No valid public keys fetched after all retries")
-    return public_keys
+            logger.error(f"Public key lookup failed: {e}")
+        finally:
+            for receiver_client_id in batch:
+                future = self._lookups.pop(receiver_client_id, None)
+                if future is not None and not future.done():
+                    future.set_result(None)
 
-# Send multiple messages
-async def send_message_to_receivers(num_messages=5):
-    public_keys = await fetch_all_public_keys()
-    receiver_client_ids = list(public_keys.keys())
-    if not public_keys:
-        logger.warning("No public keys fetched from server. Attempting to use local keys")
-        public_keys = {}
-        for receiver_client_id in RECEIVER_CLIENT_IDS:
-            public_key_path = f"keys/{receiver_client_id}_public.key"
-            if os.path.exists(public_key_path):
-                with open(public_key_path, "r") as f:
-                    public_keys[receiver_client_id] = f.read().strip()
-        receiver_client_ids = list(public_keys.keys())
-        if not public_keys:
-            logger.error("No valid public keys available (local or server). Exiting")
+    def _complete(self, receiver_client_id, public_key):
+        if public_key:
+            self._not_found.pop(receiver_client_id, None)
+            self._store(receiver_client_id, public_key)
+        else:
+            self._not_found[receiver_client_id] = time.monotonic()
+        future = self._lookups.pop(receiver_client_id, None)
+        if future is not None and not future.done():
+            future.set_result(public_key)
+
+    # Install a fetched key in the keyring, writing the key file only when the key changed
+    def _store(self, receiver_client_id, public_key):
+        key_entry = self.keyring.get(receiver_client_id)
+        if key_entry is not None and key_entry["public_key_b64"] == public_key:
             return
+        public_key_path = self.keyring.key_path(receiver_client_id)
+        try:
+            with open(public_key_path, "w") as f:
+                f.write(public_key)
+            logger.info(f"Saved public key for {receiver_client_id} to {public_key_path}")
+            self.keyring.update(receiver_client_id, public_key, os.stat(public_key_path).st_mtime_ns)
+        except Exception as e:
+            logger.error(f"Failed to save public key for {receiver_client_id}: {e}")
+            self.keyring.update(receiver_client_id, public_key)
 
-    logger.info(f"Using receiver_client_ids: {receiver_client_ids}")
+    # Re-fetch every configured or previously seen receiver so rotated and newly registered keys are picked up
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            receiver_client_ids = set(self.producer.receiver_client_ids) | set(self._not_found) | set(self.keyring.known())
+            self._not_found.clear()
+            found = await self.resolve(sorted(receiver_client_ids))
+            logger.debug(f"Refreshed public keys: {len(found)}/{len(receiver_client_ids)} found")
 
-    reader, writer = await asyncio.wait_for(
-        asyncio.open_connection(SERVER_ADDRESS, SERVER_PORT, ssl=ssl_context, server_hostname="localhost"),
-        timeout=120.0
-    )
-    start_time = time.time()
-    try:
-        logger.info(f"TLS connection established for sending messages. Cipher: {writer.get_extra_info('cipher')}")
-        await configure_server(reader, writer)
-        for i in range(num_messages):
-            message = generate_message()
-            encrypted_messages = await encrypt_message_for_receivers(message, receiver_client_ids)
-            for encrypted_message in encrypted_messages:
-                await send_message(reader, writer, encrypted_message)
-            logger.info(f"Sent message {i+1}/{num_messages}")
-        end_time = time.time()
-        logger.info(f"Sent {num_messages} messages in {end_time - start_time:.2f} seconds")
-        logger.info(f"Throughput: {num_messages / (end_time - start_time):.2f} messages/second")
-    except asyncio.TimeoutError:
-        logger.error("Timeout while sending messages")
-    finally:
-        writer.close()
-        await writer.wait_closed()
-        logger.debug("Connection closed")
+# Build the publish command line for an encrypted message
+def build_publish_command(message: dict, exchange_name: str) -> bytes:
+    payload = {
+        "message_id": message['message_id'],
+        "ciphertext": b64encode(message['ciphertext']).decode('utf-8'),
+        "receiver_client_id": message['receiver_client_id'],
+        "enc_session_key": b64encode(message['enc_session_key']).decode('utf-8'),
+        "nonce": b64encode(message['nonce']).decode('utf-8'),
+        "sent_time": message['sent_time']
+    }
+    # Creation time in epoch seconds, used by receivers for end-to-end latency
+    if 'sent_timestamp' in message:
+        payload["sent_timestamp"] = message['sent_timestamp']
+    if 'key_id' in message:
+        payload["key_id"] = message['key_id']
+    # Content was compressed before encryption
+    for field in ('compression', 'compression_dict'):
+        if field in message:
+            payload[field] = message[field]
+    if 'recipients' in message:
+        payload["recipients"] = {rid: b64encode(key).decode('utf-8') for rid, key in message['recipients'].items()}
+    message_str = json.dumps(payload, ensure_ascii=False)
+    return f"publish {exchange_name} {message['routing_key']} {message_str}\n".encode('utf-8')
+
+# Binary frames: a type byte and payload length, then the payload. A publish frame carries the exchange
+# and routing key (each prefixed with its length) followed by the binary envelope.
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_PUBLISH = 1   # client -> server
+FRAME_ACK = 2       # server -> publisher, consumer -> server; payload is the message_id
+FRAME_ERROR = 3     # server -> client; payload is the error text
+FRAME_MESSAGE = 4   # server -> consumer; payload is the envelope
+FRAME_COMMAND = 5   # text command or response (consume, heartbeat, ...)
+
+# Binary envelope: every fixed-size field in one header, then the message_id and receiver_client_id,
+# one (id length, id, sealed key) entry per recipient, and the ciphertext. Nothing is base64-encoded.
+# Header: version, flags, compression, recipient count, sent_timestamp, key_id, compression_dict,
+# nonce, enc_session_key, message_id length, receiver_client_id length, ciphertext length
+ENVELOPE_HEADER = struct.Struct(">BBBBd8sI12s80sHHI")
+ENVELOPE_VERSION = 1
+ENVELOPE_KEY_ID = 0x01
+ENVELOPE_COMPRESSION_DICT = 0x02
+ENVELOPE_SENT_TIMESTAMP = 0x04
+COMPRESSION_CODES = {None: 0, "zlib": 1, "zstd": 2}
+# Fields of an encrypted message that hold raw bytes
+BINARY_FIELDS = ("enc_session_key", "nonce", "ciphertext")
+
+# Envelope of an encrypted message as a list of buffers, so the frame is joined only once
+def envelope_parts(message: dict) -> list:
+    message_id = message['message_id'].encode('utf-8')
+    receiver_client_id = message['receiver_client_id'].encode('utf-8')
+    ciphertext = message['ciphertext']
+    recipients = message.get('recipients') or {}
+    flags = 0
+    key_id = message.get('key_id')
+    if key_id:
+        flags |= ENVELOPE_KEY_ID
+    compression_dict = message.get('compression_dict')
+    if compression_dict:
+        flags |= ENVELOPE_COMPRESSION_DICT
+    sent_timestamp = message.get('sent_timestamp')
+    if sent_timestamp is not None:
+        flags |= ENVELOPE_SENT_TIMESTAMP
+    parts = [
+        ENVELOPE_HEADER.pack(
+            ENVELOPE_VERSION, flags, COMPRESSION_CODES[message.get('compression')], len(recipients),
+            sent_timestamp or 0.0, bytes.fromhex(key_id) if key_id else b"",
+            int(compression_dict, 16) if compression_dict else 0,
+            message['nonce'], message['enc_session_key'],
+            len(message_id), len(receiver_client_id), len(ciphertext)
+        ),
+        message_id,
+        receiver_client_id
+    ]
+    for rid, sealed_key in recipients.items():
+        rid = rid.encode('utf-8')
+        parts += [bytes((len(rid),)), rid, sealed_key]
+    parts.append(ciphertext)
+    return parts
 
-async def check_server_health():
+# Build the binary publish frame for an encrypted message
+def build_publish_frame(message: dict, exchange_name: str) -> bytes:
+    exchange = exchange_name.encode('utf-8')
+    routing_key = message['routing_key'].encode('utf-8')
+    parts = [b"", bytes((len(exchange),)), exchange, bytes((len(routing_key),)), routing_key]
+    parts += envelope_parts(message)
+    parts[0] = FRAME_HEADER.pack(FRAME_PUBLISH, sum(map(len, parts)))
+    return b"".join(parts)
+
+# Read one frame; returns (frame type, payload), or None when the connection closed
+async def read_frame(reader: asyncio.StreamReader):
     try:
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(SERVER_ADDRESS, SERVER_PORT, ssl=ssl_context, server_hostname="localhost"),
-            timeout=10.0
-        )
-        writer.close()
-        await writer.wait_closed()
+        frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        return frame_type, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+# Hello exchange at connection setup: the client lists the protocol features it can use and the server answers
+# "capabilities" with the ones it also supports, which are then enabled for this connection only.
+# Returns that set, or None when the server answered with anything else (a server that predates the hello).
+# A server that does not answer at all raises asyncio.TimeoutError.
+async def negotiate_features(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, features, timeout=2.0):
+    writer.write(f"hello {' '.join(features)}\n".encode('utf-8'))
+    await writer.drain()
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        raise ConnectionError("Connection closed during the hello exchange")
+    response = line.decode('utf-8').split()
+    if response[:1] != ["capabilities"]:
+        return None
+    return set(response[1:]) & set(features)
+
+# Ask the server to switch this connection to binary frames; it stays on text lines if the server declines
+async def request_binary_frames(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout=10.0) -> bool:
+    writer.write(b"frames binary\n")
+    await writer.drain()
+    response = (await asyncio.wait_for(reader.readline(), timeout)).decode('utf-8').strip()
+    if response == "OK binary":
         return True
-    except Exception as e:
-        logger.error(f"Server health check failed: {e}")
-        return False
+    logger.warning(f"Server declined binary frames ({response}), using the text protocol")
+    return False
 
-# Send a single message with retry
-async def send_message(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, message: dict):
-    max_retries = 3
-    timeout = 30
-    message_id = message['message_id']
-    routing_key = message['routing_key']
-    message_str = json.dumps({
-        "message_id": message_id,
-        "ciphertext": message['ciphertext'],
-        "receiver_client_id": message['receiver_client_id'],
-        "enc_session_key": message['enc_session_key'],
-        "nonce": message['nonce'],
-        "sent_time": message['sent_time']
-    }, ensure_ascii=False)
-    command = f"publish {EXCHANGE_NAME} {routing_key} {message_str}\n"
-    for attempt in range(max_retries):
+# AIMD pacing for the batched message source. The controller holds a target rate; batches go out
+# every batch_interval with rate * batch_interval messages. Once per decision_interval the ACK latency,
+# publish errors and transport write buffers seen since the last decision either raise the rate by
+# rate_step or, on congestion, multiply it by decrease_factor. Latency counts as congestion above
+# max_latency, or above latency_tolerance times the lowest recent latency (and latency_floor).
+# Like TCP, the rate is cut at most once per round trip: after a decrease, decisions wait one ACK
+# latency and only messages written after the decrease count.
+class PacingController:
+    def __init__(self, enabled=True, rate=1000, min_rate=10, max_rate=100000, rate_step=50,
+                 decrease_factor=0.7, batch_interval=0.01, decision_interval=0.1, max_batch_size=1000,
+                 latency_tolerance=3.0, latency_floor=0.005, max_latency=1.0, max_error_rate=0.01):
+        self.enabled = enabled
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.decrease_factor = decrease_factor
+        self.batch_interval = batch_interval
+        self.decision_interval = decision_interval
+        self.max_batch_size = max_batch_size
+        self.latency_tolerance = latency_tolerance
+        self.latency_floor = latency_floor
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.baseline = None
+        self._latency_sum = 0.0
+        self._acks = 0
+        self._errors = 0
+        self._last_decision = time.monotonic()
+        self._decreased_at = 0.0
+        self._hold_until = 0.0
+        self._metrics = {"increases": 0, "decreases": 0, "holds": 0, "last_decrease_reason": None,
+                         "latency_ms": None, "baseline_latency_ms": None, "error_rate": 0.0, "write_buffer_pressure": 0.0}
+
+    @property
+    def batch_size(self) -> int:
+        return max(1, min(self.max_batch_size, round(self.rate * self.batch_interval)))
+
+    # Pause after a batch so that batches average out to the target rate
+    @property
+    def delay(self) -> float:
+        return self.batch_size / self.rate
+
+    # sent_at is when the message was written to the connection
+    def record_ack(self, sent_at, latency):
+        if sent_at >= self._decreased_at:
+            self._latency_sum += latency
+            self._acks += 1
+
+    def record_error(self, sent_at):
+        if sent_at >= self._decreased_at:
+            self._errors += 1
+
+    def _reset_window(self, now):
+        self._latency_sum = 0.0
+        self._acks = 0
+        self._errors = 0
+        self._last_decision = now
+
+    # Adjust the rate from the feedback collected since the previous decision
+    def update(self, write_buffer_pressure=0.0):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_decision < self.decision_interval or now < self._hold_until:
+            return
+        self._metrics["write_buffer_pressure"] = round(write_buffer_pressure, 3)
+        reason = None
+        if write_buffer_pressure >= 1.0:
+            reason = "transport write buffer full"
+        elif not self._acks and not self._errors:
+            # Nothing acknowledged yet; wait for feedback before changing pace
+            self._metrics["holds"] += 1
+            self._last_decision = now
+            return
+        else:
+            error_rate = self._errors / (self._acks + self._errors)
+            self._metrics["error_rate"] = round(error_rate, 4)
+            if self._acks:
+                latency = self._latency_sum / self._acks
+                # The baseline follows the lowest latency seen, drifting up slowly so a changed path is relearned
+                self.baseline = latency if self.baseline is None else min(latency, self.baseline * 1.01)
+                self._metrics["latency_ms"] = round(latency * 1000, 3)
+                self._metrics["baseline_latency_ms"] = round(self.baseline * 1000, 3)
+            if error_rate > self.max_error_rate:
+                reason = f"error rate {error_rate:.1%}"
+            elif self._acks and (latency > self.max_latency or
+                                 (latency > self.latency_floor and latency > self.baseline * self.latency_tolerance)):
+                reason = f"ACK latency {latency * 1000:.1f} ms (baseline {self.baseline * 1000:.1f} ms)"
+        self._reset_window(now)
+
+        if reason:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._decreased_at = now
+            self._hold_until = now + (self._metrics["latency_ms"] or 0) / 1000
+            self._metrics["decreases"] += 1
+            self._metrics["last_decrease_reason"] = reason
+            logger.info("Pacing down to %.0f messages/s: %s", self.rate, reason)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+            self._metrics["increases"] += 1
+            logger.debug("Pacing up to %.0f messages/s", self.rate)
+
+    def metrics(self) -> dict:
+        return {"rate": round(self.rate, 1), "batch_size": self.batch_size, "delay_ms": round(self.delay * 1000, 3),
+                **self._metrics}
+
+# Retry timers for all publishing connections: one heap and a single loop timer armed for the earliest entry,
+# so messages waiting out a backoff hold neither a task nor a window slot.
+# Backoff is exponential with equal jitter: attempt n waits between half and all of
+# min(max_delay, base_delay * 2 ** (n - 1)), which keeps a burst of timeouts from retrying in lockstep.
+class RetryScheduler:
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=30.0, deadline=120.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        # (due in loop time, sequence, callback, args)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self.scheduled = 0
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # Run callback(*args) on the event loop after delay seconds
+    def schedule(self, delay, callback, *args):
+        loop = asyncio.get_running_loop()
+        due = loop.time() + delay
+        heapq.heappush(self._heap, (due, next(self._sequence), callback, args))
+        self.scheduled += 1
+        if self._timer is None or due < self._timer.when():
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = loop.call_at(due, self._fire)
+
+    def _fire(self):
+        loop = asyncio.get_running_loop()
+        self._timer = None
+        while self._heap and self._heap[0][0] <= loop.time():
+            _, _, callback, args = heapq.heappop(self._heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error(f"Retry callback failed: {e}")
+        if self._heap:
+            self._timer = loop.call_at(self._heap[0][0], self._fire)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._heap.clear()
+
+# A message being published: the message and its encoded command, attempts so far, the time it must be
+# acknowledged by, and the future that resolves to True on ACK or False once it failed for good
+class Delivery:
+    __slots__ = ("message_id", "message", "command", "attempt", "deadline", "outcome")
+
+    def __init__(self, message, command, deadline, outcome):
+        self.message_id = message['message_id']
+        self.message = message
+        self.command = command
+        self.attempt = 0
+        self.deadline = deadline
+        self.outcome = outcome
+
+# Pipelined publishing: keeps up to window_size messages in flight on one connection.
+# on_ack is called with the message_id of every acknowledged message; the pacer gets ACK and error feedback.
+# A timed-out publish gives its slot back and waits for its retry in the RetryScheduler, so fresh messages
+# keep flowing; the retry takes a slot again when it is due.
+# When the connection is lost, on_lost is called once and every unanswered delivery is handed to requeue
+# instead of failing, so the owner can send it again on a new connection.
+class PublishWindow:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, exchange_name, on_ack, pacer,
+                 retries: RetryScheduler, window_size=64, timeout=30, binary=False, requeue=None, on_lost=None):
+        self.reader = reader
+        self.writer = writer
+        self.binary = binary
+        self.exchange_name = exchange_name
+        self.on_ack = on_ack
+        self.pacer = pacer
+        self.retries = retries
+        self.window_size = window_size
+        self.timeout = timeout
+        self.requeue = requeue
+        self.on_lost = on_lost
+        # Set once the connection is gone; nothing more is written and unanswered deliveries go to requeue
+        self.lost = False
+        self._slots = asyncio.Semaphore(window_size)
+        self._write_lock = asyncio.Lock()
+        # message_id -> future resolved with the broker response for that message
+        self._in_flight = {}
+        # message_id -> Delivery waiting in the retry scheduler
+        self._waiting = {}
+        # Ids of sent publishes still owed a reply, in send order, timed-out ones included:
+        # errors carry no message_id, so they are matched to a publish by position
+        self._sent = deque()
+        self._reader_task = None
+        # Running deliveries and retries; the event loop only keeps weak references to tasks
+        self._tasks = set()
+        self._closed = False
+
+    def start(self):
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        self._closed = True
+        for delivery in self._waiting.values():
+            self._finish(delivery, False)
+        self._waiting.clear()
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+
+    def _encode(self, message: dict) -> bytes:
+        if self.binary:
+            return build_publish_frame(message, self.exchange_name)
+        return build_publish_command(message, self.exchange_name)
+
+    # Wait for a free slot, then publish in the background; the future resolves to True on ACK
+    async def submit(self, message: dict) -> asyncio.Future:
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        delivery = Delivery(message, self._encode(message), time.monotonic() + self.retries.deadline, loop.create_future())
+        self._spawn(self._deliver(delivery))
+        return delivery.outcome
+
+    # Take over a delivery from a lost connection; it keeps its outcome, attempts and deadline
+    def resubmit(self, delivery: Delivery):
+        if time.monotonic() >= delivery.deadline:
+            logger.error(f"Giving up on message {delivery.message_id}: delivery deadline reached")
+            self._finish(delivery, False)
+            return
+        # The new connection may use the other wire format
+        delivery.command = self._encode(delivery.message)
+        self._spawn(self._retry(delivery))
+
+    # Next server response as text: a line, or an ACK/error frame on binary connections; None once closed
+    async def _read_response(self):
+        if not self.binary:
+            line = await self.reader.readline()
+            return line.decode('utf-8').strip() if line else None
+        frame = await read_frame(self.reader)
+        if frame is None:
+            return None
+        frame_type, payload = frame
+        if frame_type == FRAME_ACK:
+            return "ACK " + payload.decode('utf-8')
+        if frame_type in (FRAME_ERROR, FRAME_COMMAND):
+            return payload.decode('utf-8')
+        return f"Unexpected frame type {frame_type}"
+
+    async def _read_responses(self):
         try:
-            logger.debug(f"Sending message {message_id} (Attempt {attempt + 1}/{max_retries})")
-            writer.write(command.encode('utf-8'))
-            await writer.drain()
-            response = (await asyncio.wait_for(reader.readline(), timeout=timeout)).decode('utf-8').strip()
-            logger.debug(f"Received response: {response}")
-            if response == f"ACK {message_id}":
-                logger.info(f"ACK received for message {message_id}")
-                pending_messages.pop(message_id, None)
-                return True
-            elif response.startswith("Error:"):
-                logger.error(f"Server error for message {message_id}: {response}")
-                return False
-            else:
-                logger.warning(f"Unexpected response for message {message_id}: {response}")
-        except asyncio.TimeoutError:
-            logger.warning(f"Timeout for message {message_id}, retrying ({attempt + 1}/{max_retries})")
+            while True:
+                response = await self._read_response()
+                if response is None:
+                    logger.error("Connection closed by server")
+                    break
+                if not response:
+                    continue
+                logger.debug("Received response: %s", response)
+                if response.startswith("ACK "):
+                    self._answered(response[4:])
+                    future = self._in_flight.pop(response[4:], None)
+                    if future is None:
+                        # An ACK that arrived after the publish timed out settles it; the retry is dropped
+                        delivery = self._waiting.pop(response[4:], None)
+                        if delivery is not None:
+                            logger.info("Late ACK received for message %s", delivery.message_id)
+                            self.on_ack(delivery.message_id)
+                            self._finish(delivery, True)
+                        else:
+                            logger.debug("Late or duplicate ACK: %s", response)
+                        continue
+                elif self._sent:
+                    # The broker answers in order, so the reply belongs to the oldest publish still owed one
+                    message_id = self._sent.popleft()
+                    future = self._in_flight.pop(message_id, None)
+                    if future is None:
+                        # A late reply to a publish that timed out; it is not retried
+                        delivery = self._waiting.pop(message_id, None)
+                        if delivery is not None:
+                            logger.error(f"Late server error for message {message_id}: {response}")
+                            self._finish(delivery, False)
+                        else:
+                            logger.debug("Late reply for message %s: %s", message_id, response)
+                        continue
+                else:
+                    logger.warning(f"Unexpected response with no message in flight: {response}")
+                    continue
+                if not future.done():
+                    future.set_result(response)
         except Exception as e:
-            logger.error(f"Error sending message {message_id}: {e}")
-            return False
-        await asyncio.sleep(2 ** attempt)
-    logger.error(f"Failed to send message {message_id} after {max_retries} attempts")
-    return False
+            logger.error(f"Error reading server responses: {e}")
+        finally:
+            self._connection_lost()
+            for future in self._in_flight.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to server lost"))
+            self._in_flight.clear()
+            self._sent.clear()
 
-# Send batch of messages
-async def send_messages_persistent(num_messages=100):
-    public_keys = await fetch_all_public_keys()
-    receiver_client_ids = list(public_keys.keys())
-    if not public_keys:
-        logger.error("No valid public keys available. Exiting")
-        return
+    # Hand everything waiting for a retry to the owner and tell it once; not when the window was closed
+    def _connection_lost(self):
+        if self._closed or self.lost or self.requeue is None:
+            return
+        self.lost = True
+        waiting = list(self._waiting.values())
+        self._waiting.clear()
+        for delivery in waiting:
+            self.requeue(delivery)
+        if self.on_lost is not None:
+            self.on_lost()
 
-    logger.info(f"Using receiver_client_ids: {receiver_client_ids}")
+    # Drop an acknowledged publish from the send order. Timed-out publishes sent before it that are not
+    # in flight again lost their reply, so they go too rather than absorbing a later error.
+    def _answered(self, message_id):
+        try:
+            index = self._sent.index(message_id)
+        except ValueError:
+            return
+        earlier = [self._sent.popleft() for _ in range(index)]
+        self._sent.popleft()
+        self._sent.extendleft(reversed([sent_id for sent_id in earlier if sent_id in self._in_flight]))
 
-    reader, writer = await asyncio.wait_for(
-        asyncio.open_connection(SERVER_ADDRESS, SERVER_PORT, ssl=ssl_context, server_hostname="localhost"),
-        timeout=120.0
-    )
+    @staticmethod
+    def _finish(delivery: Delivery, success: bool):
+        if not delivery.outcome.done():
+            delivery.outcome.set_result(success)
+
+    # One publish attempt; runs holding a window slot and releases it when the attempt is over
+    async def _deliver(self, delivery: Delivery):
+        if self.lost:
+            self._slots.release()
+            self.requeue(delivery)
+            return
+        message_id = delivery.message_id
+        delivery.attempt += 1
+        max_attempts = self.retries.max_attempts
+        sent_at = time.monotonic()
+        try:
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[message_id] = future
+            try:
+                logger.debug("Sending message %s (Attempt %d/%d)", message_id, delivery.attempt, max_attempts)
+                async with self._write_lock:
+                    self.writer.write(delivery.command)
+                    self._sent.append(message_id)
+                    await self.writer.drain()
+                sent_at = time.monotonic()
+                timeout = max(0.0, min(self.timeout, delivery.deadline - sent_at))
+                response = await asyncio.wait_for(future, timeout=timeout)
+            except asyncio.TimeoutError:
+                self._in_flight.pop(message_id, None)
+                self.pacer.record_error(sent_at)
+                logger.warning(f"Timeout for message {message_id} ({delivery.attempt}/{max_attempts})")
+            except Exception as e:
+                self._in_flight.pop(message_id, None)
+                # The reader may have failed the future while the write was still draining
+                if future.done() and not future.cancelled():
+                    future.exception()
+                if isinstance(e, (ConnectionError, OSError)):
+                    self._connection_lost()
+                if self.lost:
+                    # The connection failed, not the publish: send it again on the next one
+                    delivery.attempt -= 1
+                    self.requeue(delivery)
+                    return
+                self.pacer.record_error(time.monotonic())
+                logger.error(f"Error sending message {message_id}: {e}")
+                self._finish(delivery, False)
+                return
+            else:
+                if response == f"ACK {message_id}":
+                    logger.info("ACK received for message %s", message_id)
+                    self.pacer.record_ack(sent_at, time.monotonic() - sent_at)
+                    self.on_ack(message_id)
+                    self._finish(delivery, True)
+                    return
+                elif response.startswith("Error:"):
+                    self.pacer.record_error(sent_at)
+                    logger.error(f"Server error for message {message_id}: {response}")
+                    self._finish(delivery, False)
+                    return
+                else:
+                    logger.warning(f"Unexpected response for message {message_id}: {response}")
+        finally:
+            self._slots.release()
+        self._schedule_retry(delivery)
+
+    def _schedule_retry(self, delivery: Delivery):
+        if self.lost:
+            self.requeue(delivery)
+            return
+        if self._closed:
+            self._finish(delivery, False)
+            return
+        if delivery.attempt >= self.retries.max_attempts:
+            logger.error(f"Failed to send message {delivery.message_id} after {delivery.attempt} attempts")
+            self._finish(delivery, False)
+            return
+        delay = self.retries.backoff(delivery.attempt)
+        if time.monotonic() + delay >= delivery.deadline:
+            logger.error(f"Giving up on message {delivery.message_id}: delivery deadline reached")
+            self._finish(delivery, False)
+            return
+        logger.debug("Retrying message %s in %.3fs", delivery.message_id, delay)
+        self._waiting[delivery.message_id] = delivery
+        self.retries.schedule(delay, self._retry_due, delivery)
+
+    def _retry_due(self, delivery: Delivery):
+        if self._waiting.get(delivery.message_id) is not delivery:
+            return
+        del self._waiting[delivery.message_id]
+        self._spawn(self._retry(delivery))
+
+    # Retries queue for a slot behind the fresh publishes already waiting
+    async def _retry(self, delivery: Delivery):
+        await self._slots.acquire()
+        if self._closed and not self.lost:
+            self._slots.release()
+            self._finish(delivery, False)
+            return
+        await self._deliver(delivery)
+
+# One publishing connection with its own writer task and ACK tracking. A lost connection is reopened with
+# backoff; publishes it had not got an answer for are sent again on the new one instead of failing.
+class PublisherConnection:
+    def __init__(self, producer, index: int):
+        self.producer = producer
+        self.index = index
+        self.queue = asyncio.Queue(maxsize=producer.queue_size)
+        # message_id -> (encrypted message, outcome future) until the broker has answered
+        self.unresolved = {}
+        # Messages that failed for good, handed back by flush(); as bounded as the pending store
+        self.failed = deque(maxlen=producer.pending_messages.max_messages)
+        self.reader = None
+        self.writer = None
+        self.window = None
+        # Set while there is a live window to publish on
+        self.ready = asyncio.Event()
+        # Deliveries from a lost connection, sent again once the next one is open
+        self._requeued = []
+        self._writer_task = None
+        self._reconnect_task = None
+        self._closed = False
+
+    async def open(self):
+        await self._open()
+        self._writer_task = asyncio.create_task(self._write())
+
+    async def _open(self):
+        producer = self.producer
+        self.reader, self.writer, features = await producer.open_connection(f"publishing (connection {self.index})")
+        binary = "binary_frames" in features and await request_binary_frames(self.reader, self.writer)
+        self.window = PublishWindow(
+            self.reader, self.writer, producer.exchange_name, producer.acknowledge, producer.pacer, producer.retries,
+            window_size=producer.window_size,
+            timeout=producer.ack_timeout,
+            binary=binary,
+            requeue=self._requeue,
+            on_lost=self._connection_lost
+        )
+        self.window.start()
+        self.ready.set()
+        requeued, self._requeued = self._requeued, []
+        if requeued:
+            logger.info(f"Resending {len(requeued)} unacknowledged messages on publishing connection {self.index}")
+        for delivery in requeued:
+            self.window.resubmit(delivery)
+
+    def _requeue(self, delivery: Delivery):
+        if self._closed:
+            PublishWindow._finish(delivery, False)
+        elif self.window is not None and not self.window.lost:
+            self.window.resubmit(delivery)
+        else:
+            self._requeued.append(delivery)
+
+    def _connection_lost(self):
+        if self._closed or self._reconnect_task is not None:
+            return
+        self.ready.clear()
+        # A restarted server may have lost the topology too
+        self.producer.declared_topology.clear()
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        await self.window.close()
+        if self.writer is not None:
+            self.writer.close()
+        attempt = 0
+        while not self._closed:
+            attempt += 1
+            delay = self.producer.retries.backoff(attempt)
+            logger.warning(f"Publishing connection {self.index} lost, reconnecting in {delay:.2f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Reconnecting publishing connection {self.index} failed: {str(e) or 'timed out'}")
+                continue
+            logger.info(f"Publishing connection {self.index} reconnected after {attempt} attempt(s)")
+            break
+        self._reconnect_task = None
+
+    # Publish on the current window, waiting out a reconnect
+    async def submit(self, message: dict) -> asyncio.Future:
+        await self.ready.wait()
+        return await self.window.submit(message)
+
+    async def _write(self):
+        while True:
+            encrypted_message, durable, result = await self.queue.get()
+            try:
+                # Never publish a message before the outbox has it on disk
+                if durable is not None:
+                    await durable
+                outcome = await self.submit(encrypted_message)
+                self.unresolved[encrypted_message['message_id']] = (encrypted_message, outcome)
+                outcome.add_done_callback(partial(self._settled, encrypted_message))
+                outcome.add_done_callback(partial(self._resolve, result))
+            except Exception as e:
+                logger.error(f"Could not publish message {encrypted_message['message_id']}: {e}")
+                self._resolve(result, None)
+            finally:
+                self.queue.task_done()
+
+    # Complete the dispatcher's future with whether the publish was acknowledged
+    @staticmethod
+    def _resolve(result, outcome):
+        if result is not None and not result.done():
+            result.set_result(outcome is not None and not outcome.cancelled() and outcome.exception() is None
+                              and outcome.result())
+
+    # Forget an answered message; only failures are kept for flush()
+    def _settled(self, encrypted_message, outcome):
+        message_id = encrypted_message['message_id']
+        entry = self.unresolved.get(message_id)
+        if entry is not None and entry[1] is outcome:
+            del self.unresolved[message_id]
+        if outcome.cancelled() or outcome.exception() is not None or outcome.result() is not True:
+            if len(self.failed) == self.failed.maxlen:
+                logger.warning(f"Too many failed messages held, dropping {self.failed[0]['message_id']}")
+            self.failed.append(encrypted_message)
+
+    # Wait until every queued message has been published and answered; returns the failed messages
+    async def flush(self) -> list:
+        await self.queue.join()
+        while self.unresolved:
+            await asyncio.gather(*(outcome for _, outcome in list(self.unresolved.values())), return_exceptions=True)
+            # Let the outcomes' done callbacks run before looking again
+            await asyncio.sleep(0)
+        failed = list(self.failed)
+        self.failed.clear()
+        return failed
+
+    async def close(self):
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        requeued, self._requeued = self._requeued, []
+        for delivery in requeued:
+            PublishWindow._finish(delivery, False)
+        if self.window:
+            await self.window.close()
+        if self._writer_task and not self._writer_task.done():
+            self._writer_task.cancel()
+        if self.writer:
+            self.writer.close()
+            with contextlib.suppress(OSError):
+                await self.writer.wait_closed()
+
+# Pool of publishing connections; messages are sharded by routing key so per-key order is kept
+class PublisherPool:
+    def __init__(self, producer, size: int, routing_keys=()):
+        self.connections = [PublisherConnection(producer, i) for i in range(max(1, size))]
+        # Sticky routing_key -> shard map; known keys are spread round-robin
+        self._shards = {}
+        for routing_key in routing_keys:
+            self._shards.setdefault(routing_key, len(self._shards) % len(self.connections))
 
+    async def open(self):
+        await asyncio.gather(*(connection.open() for connection in self.connections))
+
+    def connection_for(self, routing_key: str) -> PublisherConnection:
+        shard = self._shards.get(routing_key)
+        if shard is None:
+            shard = self._shards[routing_key] = zlib.crc32(routing_key.encode('utf-8')) % len(self.connections)
+        return self.connections[shard]
+
+    # Queue a message on its shard; the returned future resolves to True once it is acknowledged
+    async def dispatch(self, encrypted_message: dict, durable=None) -> asyncio.Future:
+        result = asyncio.get_running_loop().create_future()
+        await self.connection_for(encrypted_message['routing_key']).queue.put((encrypted_message, durable, result))
+        return result
+
+    async def flush(self) -> list:
+        failed = await asyncio.gather(*(connection.flush() for connection in self.connections))
+        return [message for messages in failed for message in messages]
+
+    # Publish failed messages once more on their shard's connection
+    async def retry(self, messages: list):
+        retries = [await self.connection_for(message['routing_key']).submit(message) for message in messages]
+        return await asyncio.gather(*retries)
+
+    # Fullest transport write buffer relative to its high-water mark; at 1.0 writers block in drain()
+    def write_buffer_pressure(self) -> float:
+        pressure = 0.0
+        for connection in self.connections:
+            if connection.writer is None or connection.writer.is_closing():
+                continue
+            transport = connection.writer.transport
+            try:
+                high_water = transport.get_write_buffer_limits()[1]
+            except (AttributeError, NotImplementedError):
+                high_water = 64 * 1024
+            if high_water:
+                pressure = max(pressure, transport.get_write_buffer_size() / high_water)
+        return pressure
+
+    async def close(self):
+        await asyncio.gather(*(connection.close() for connection in self.connections), return_exceptions=True)
+
+# Embeddable producer. Each instance owns its connections, keyring, pending store, outbox and encryption
+# workers, so several can run in one process; nothing touches the network or disk before setup()/connect().
+#
+#     async with CipherMQProducer(load_config()) as producer:
+#         acked = await producer.publish("hello", ["receiver_1"])
+#         print(await acked)
+class CipherMQProducer:
+    def __init__(self, config, client_id=None, connections=None, key_dir="keys"):
+        self.config = config
+        self.client_id = client_id
+        self.exchange_name = config["exchange_name"]
+        self.bindings = config.get("bindings", [])
+        self.server_address = config["server_address"]
+        self.server_port = config["server_port"]
+        self.tls_config = config["tls"]
+        receiver_client_ids = config.get("receiver_client_ids", ["receiver_1"])
+        if isinstance(receiver_client_ids, str):
+            receiver_client_ids = [receiver_client_ids]
+        self.receiver_client_ids = list(receiver_client_ids)
+        publish_config = config.get("publish", {})
+        self.window_size = publish_config.get("window_size", 64)
+        self.max_retries = publish_config.get("max_retries", 3)
+        self.ack_timeout = publish_config.get("ack_timeout", 30)
+        # Backoff timers shared by all publishing connections
+        self.retries = RetryScheduler(
+            self.max_retries,
+            publish_config.get("retry_base_delay_ms", 500) / 1000,
+            publish_config.get("retry_max_delay_ms", 30000) / 1000,
+            publish_config.get("delivery_deadline", 120)
+        )
+        self.connections = connections or publish_config.get("connections", 1)
+        pipeline_config = config.get("pipeline", {})
+        self.executor_kind = pipeline_config.get("executor", "thread")
+        self.encrypt_workers = pipeline_config.get("encrypt_workers", os.cpu_count() or 1)
+        self.queue_size = pipeline_config.get("queue_size", 256)
+        # "text" lines or "binary" frames on the publishing connections
+        self.wire_format = config.get("wire", {}).get("format", "text")
+        protocol_config = config.get("protocol", {})
+        self.negotiate = protocol_config.get("negotiate", True)
+        self.hello_timeout = protocol_config.get("hello_timeout", 2.0)
+        self.legacy_recheck_interval = protocol_config.get("legacy_recheck_interval", 300)
+        # Features offered in the hello; nothing to offer means no hello at all
+        self.protocol_features = ["binary_frames"] if self.wire_format == "binary" else []
+        # The server did not understand the hello: connections skip it until this time
+        self._legacy_until = 0.0
+        self.encryption_config = config.get("encryption", {})
+        self.compression_config = config.get("compression", {})
+
+        # Public keys of receivers, parsed once and kept in memory
+        self.keyring = PublicKeyring(key_dir, self.bindings, config.get("keyring", {}).get("recheck_interval", 5.0))
+        key_directory_config = config.get("key_directory", {})
+        self.key_directory = KeyDirectory(
+            self, key_directory_config.get("refresh_interval", 300), key_directory_config.get("negative_ttl", 30)
+        )
+        # Stores pending messages until acknowledged
+        pending_config = config.get("pending", {})
+        self.pending_messages = PendingStore(
+            pending_config.get("max_messages", 10000),
+            int(pending_config.get("max_size_mb", 64) * 1_000_000),
+            pending_config.get("policy", "block"),
+            pending_config.get("failed_ttl", 300)
+        )
+        outbox_config = config.get("outbox", {})
+        self.outbox = Outbox(
+            outbox_config.get("path", "outbox"),
+            int(outbox_config.get("segment_size_mb", 16) * 1_000_000),
+            outbox_config.get("commit_interval_ms", 5) / 1000,
+            outbox_config.get("commit_max_records", 256)
+        ) if outbox_config.get("enabled", False) else None
+        pacing_config = config.get("pacing", {})
+        self.pacer = PacingController(
+            pacing_config.get("enabled", True),
+            pacing_config.get("initial_rate", 1000),
+            pacing_config.get("min_rate", 10),
+            pacing_config.get("max_rate", 100000),
+            pacing_config.get("rate_step", 50),
+            pacing_config.get("decrease_factor", 0.7),
+            pacing_config.get("batch_interval_ms", 10) / 1000,
+            pacing_config.get("decision_interval_ms", 100) / 1000,
+            pacing_config.get("max_batch_size", 1000),
+            pacing_config.get("latency_tolerance", 3.0),
+            pacing_config.get("latency_floor_ms", 5) / 1000,
+            pacing_config.get("max_latency_ms", 1000) / 1000,
+            pacing_config.get("max_error_rate", 0.01)
+        )
+        # Callables notified with the message_id of every acknowledged message
+        self.ack_listeners = []
+        # Topology already declared by this producer: command -> future resolved with True once the server accepted it
+        self.declared_topology = {}
+        self.ssl_context = None
+        self.encryptor = None
+        self.executor = None
+        self.pool = None
+        # (encryption future, publish future) in publish order; the bound keeps publishers from running ahead of the sockets
+        self._encrypted = None
+        self._dispatcher = None
+        # publish() futures not resolved yet, cancelled on close
+        self._publishes = set()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Load the client certificate and build the encryption stage; the first connection does this implicitly
+    def setup(self):
+        if self.ssl_context is not None:
+            return
+        if self.client_id is None:
+            self.client_id = extract_client_id(self.tls_config)
+            logger.info(f"Extracted client_id from certificate: {self.client_id}")
+        os.makedirs(self.keyring.key_dir, exist_ok=True)
+        compression = None
+        if self.compression_config.get("enabled", False):
+            dictionary = self.compression_config.get("dictionary")
+            compression = {
+                "algorithm": self.compression_config.get("algorithm", "zlib"),
+                "level": self.compression_config.get("level"),
+                "min_size": self.compression_config.get("min_size", 512),
+                "dictionary": load_compression_dictionary(dictionary) if dictionary else None
+            }
+        self.encryptor = MessageEncryptor(
+            self.encryption_config.get("multi_recipient", True),
+            self.encryption_config.get("session_keys", False),
+            self.encryption_config.get("session_rotate_messages", 10000),
+            self.encryption_config.get("session_rotate_seconds", 300),
+            compression
+        )
+        self.ssl_context = create_ssl_context(self.tls_config)
+
+    # Open an mTLS connection to the server, timing the connect and handshake, negotiate protocol features and
+    # declare the topology on it. Returns (reader, writer, features enabled on this connection).
+    async def open_connection(self, purpose, timeout=120.0):
+        self.setup()
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server_address, self.server_port, ssl=self.ssl_context, server_hostname="localhost"),
+            timeout=timeout
+        )
+        elapsed = time.perf_counter() - started
+        resumed = self.ssl_context.record_handshake(writer, elapsed)
+        logger.info(f"TLS connection established for {purpose} in {elapsed * 1000:.1f} ms "
+                    f"({'resumed session' if resumed else 'full handshake'}). Cipher: {writer.get_extra_info('cipher')}")
+        try:
+            features = await self.negotiate_features(reader, writer)
+            if features is None:
+                # A late answer to the hello would be read as the reply to the next command, so start over
+                writer.close()
+                return await self.open_connection(purpose, timeout)
+            await self.configure_server(reader, writer)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, features
+
+    # Run the hello exchange unless the server is known not to support it. Returns the enabled features,
+    # or None when the server never answered and the connection has to be replaced.
+    async def negotiate_features(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not self.negotiate or not self.protocol_features or time.monotonic() < self._legacy_until:
+            return set()
+        try:
+            features = await negotiate_features(reader, writer, self.protocol_features, self.hello_timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self._mark_legacy(f"no answer to hello: {str(e) or 'timed out'}")
+            return None
+        if features is None:
+            self._mark_legacy("hello not supported")
+            return set()
+        logger.info(f"Negotiated protocol features: {', '.join(sorted(features)) or 'none'}")
+        return features
+
+    def _mark_legacy(self, reason):
+        self._legacy_until = time.monotonic() + self.legacy_recheck_interval
+        logger.warning(f"Server does not negotiate protocol features ({reason}); using the text protocol "
+                       f"for the next {self.legacy_recheck_interval}s")
+
+    # Configure server with queue, exchange, and bindings.
+    # New commands go out as one pipelined batch; anything this producer already declared is skipped.
+    async def configure_server(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        commands = []
+        declared_elsewhere = []
+        for binding in self.bindings:
+            queue_name = binding["queue_name"]
+            exchange_name = binding["exchange_name"]
+            routing_key = binding["routing_key"]
+            for command in (f"declare_queue {queue_name}",
+                            f"declare_exchange {exchange_name}",
+                            f"bind {queue_name} {exchange_name} {routing_key}"):
+                if command in self.declared_topology:
+                    declared_elsewhere.append(self.declared_topology[command])
+                else:
+                    self.declared_topology[command] = loop.create_future()
+                    commands.append(command)
+
+        if commands:
+            logger.debug(f"Sending {len(commands)} topology commands in one batch")
+            try:
+                writer.write("".join(f"{command}\n" for command in commands).encode('utf-8'))
+                await writer.drain()
+                for command in commands:
+                    response = (await reader.readline()).decode('utf-8').strip()
+                    logger.info(f"Server response for {TOPOLOGY_LABELS[command.split(' ', 1)[0]]}: {response}")
+                    accepted = bool(response) and not response.startswith("Error")
+                    future = self.declared_topology[command]
+                    if not accepted:
+                        del self.declared_topology[command]
+                    future.set_result(accepted)
+            finally:
+                # Commands left unanswered must be declared again by the next connection
+                for command in commands:
+                    future = self.declared_topology.get(command)
+                    if future is not None and not future.done():
+                        del self.declared_topology[command]
+                        future.set_result(False)
+        else:
+            logger.debug("Topology already declared by this producer, skipping")
+        self.ssl_context.remember_session(writer)
+
+        # Another connection may still be waiting on the server for part of the topology
+        if declared_elsewhere:
+            await asyncio.gather(*declared_elsewhere)
+
+    # Fetch public keys for all receivers in one pipelined round trip and save them to files
+    async def fetch_all_public_keys(self):
+        public_keys = await self.key_directory.resolve(self.receiver_client_ids)
+        for receiver_client_id in self.receiver_client_ids:
+            if receiver_client_id not in public_keys:
+                logger.warning(f"Skipping {receiver_client_id} due to missing public key")
+        if not public_keys:
+            logger.error("No valid public keys fetched from server")
+        return public_keys
+
+    # Resolve (receiver_client_id, sealed_box, routing_key) targets from the keyring
+    # Receivers without a key yet are looked up on the server on demand
+    async def resolve_targets(self, receiver_client_ids: list) -> list:
+        missing = [receiver_client_id for receiver_client_id in receiver_client_ids if self.keyring.get(receiver_client_id) is None]
+        if missing:
+            await self.key_directory.resolve(missing)
+        targets = []
+        for receiver_client_id in receiver_client_ids:
+            key_entry = self.keyring.get(receiver_client_id)
+            if key_entry is None:
+                logger.debug("Public key for %s not available, skipping", receiver_client_id)
+                continue
+            targets.append((receiver_client_id, key_entry["sealed_box"], key_entry["routing_key"]))
+        return targets
+
+    # Worker pool for the encryption stage
+    def create_encrypt_executor(self):
+        if self.executor_kind == "process":
+            return ProcessPoolExecutor(max_workers=self.encrypt_workers,
+                                       initializer=init_encrypt_worker, initargs=(self.encryptor.settings,))
+        return ThreadPoolExecutor(max_workers=self.encrypt_workers, thread_name_prefix="encrypt")
+
+    # Encrypt on the worker pool; the future resolves to the encrypted messages, one per routing key
+    def encrypt(self, message: dict, targets: list) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self.executor_kind == "process":
+            return loop.run_in_executor(self.executor, encrypt_in_worker, message, targets)
+        return loop.run_in_executor(self.executor, self.encryptor.encrypt_for_targets, message, targets)
+
+    # Release a message once the broker acknowledged it
+    def acknowledge(self, message_id):
+        self.pending_messages.ack(message_id)
+        if self.outbox is not None:
+            self.outbox.ack(message_id)
+        for listener in self.ack_listeners:
+            listener(message_id)
+
+    # Start the key refresh and the outbox, open the publishing connections and replay
+    # whatever a previous run left unacknowledged
+    async def connect(self):
+        self.setup()
+        # Receivers that register their key later are resolved on demand and by the background refresh
+        self.key_directory.start()
+        recovered_messages = []
+        if self.outbox is not None:
+            recovered_messages = self.outbox.recover()
+            self.outbox.start()
+
+        self.executor = self.create_encrypt_executor()
+        self.pool = PublisherPool(self, self.connections, [self.keyring.routing_key_for(receiver_client_id) for receiver_client_id in self.receiver_client_ids])
+        await self.pool.open()
+        binary = sum(connection.window.binary for connection in self.pool.connections)
+        logger.info(f"Pipelined publishing over {len(self.pool.connections)} connection(s) "
+                    f"({binary} binary) with up to {self.window_size} messages in flight each")
+        self._encrypted = asyncio.Queue(maxsize=self.queue_size)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+        # Messages a previous run left unacknowledged go out first; they are settled like any publish
+        if recovered_messages:
+            logger.info(f"Replaying {len(recovered_messages)} messages from outbox")
+            replayed = []
+            for encrypted_message in recovered_messages:
+                if await self.pending_messages.add(encrypted_message):
+                    replayed.append((encrypted_message, await self.pool.dispatch(encrypted_message)))
+            if replayed:
+                done = asyncio.get_running_loop().create_future()
+                self._publishes.add(done)
+                done.add_done_callback(self._publishes.discard)
+                messages = [message for message, _ in replayed]
+                results = asyncio.gather(*(result for _, result in replayed))
+                results.add_done_callback(partial(self._settle, done, messages))
+                results.add_done_callback(partial(self._report_replay, messages))
+        logger.info(f"Encrypting on {self.encrypt_workers} {self.executor_kind} worker(s)")
+
+    # Encrypt and publish content to the given receivers (the configured ones by default).
+    # Returns once the message is queued; the future resolves to True when every copy was acknowledged.
+    async def publish(self, content: str, receivers=None) -> asyncio.Future:
+        return await self.publish_message(generate_message(self.client_id, content=content), receivers)
+
+    async def publish_message(self, message: dict, receivers=None) -> asyncio.Future:
+        if self._dispatcher is None:
+            raise ConnectionError("Producer is not connected")
+        targets = await self.resolve_targets(receivers or self.receiver_client_ids)
+        done = asyncio.get_running_loop().create_future()
+        self._publishes.add(done)
+        done.add_done_callback(self._publishes.discard)
+        await self._encrypted.put((self.encrypt(message, targets), done))
+        return done
+
+    # Route encrypted messages, in publish order, to their shard's connection
+    async def _dispatch(self):
+        while True:
+            encrypted, done = await self._encrypted.get()
+            try:
+                dispatched = []
+                for encrypted_message in await encrypted:
+                    if await self.pending_messages.add(encrypted_message):
+                        durable = self.outbox.append(encrypted_message) if self.outbox is not None else None
+                        dispatched.append((encrypted_message, await self.pool.dispatch(encrypted_message, durable)))
+                if dispatched:
+                    results = asyncio.gather(*(result for _, result in dispatched))
+                    results.add_done_callback(partial(self._settle, done, [message for message, _ in dispatched]))
+                elif not done.done():
+                    done.set_result(False)
+            except Exception as e:
+                logger.error(f"Failed to dispatch message: {e}")
+                if not done.done():
+                    done.set_result(False)
+            finally:
+                self._encrypted.task_done()
+
+    # Resolve a publish() future once every copy was answered; failed copies leave the in-flight set
+    def _settle(self, done, encrypted_messages, results):
+        results = [False] * len(encrypted_messages) if results.cancelled() else results.result()
+        for encrypted_message, success in zip(encrypted_messages, results):
+            if not success:
+                self.pending_messages.fail(encrypted_message['message_id'])
+        if not done.done():
+            done.set_result(all(results))
+
+    # Failed replays stay in the outbox for the next run and are handed back by flush() like any failed publish
+    @staticmethod
+    def _report_replay(encrypted_messages, results):
+        results = [False] * len(encrypted_messages) if results.cancelled() else results.result()
+        failed = [message['message_id'] for message, success in zip(encrypted_messages, results) if not success]
+        if failed:
+            logger.error(f"{len(failed)} of {len(encrypted_messages)} messages replayed from outbox failed: "
+                         f"{', '.join(failed[:10])}{' ...' if len(failed) > 10 else ''}")
+        else:
+            logger.info(f"All {len(encrypted_messages)} messages replayed from outbox were acknowledged")
+
+    # Wait until everything published so far was answered; returns the messages that failed
+    async def flush(self) -> list:
+        if self._dispatcher is None:
+            return []
+        await self._encrypted.join()
+        return await self.pool.flush()
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        self.retries.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        await self.key_directory.close()
+        if self.outbox is not None:
+            await self.outbox.close()
+        for done in list(self._publishes):
+            done.cancel()
+
+# Health check over the key directory connection rather than a fresh handshake
+async def check_server_health(producer):
     try:
-        logger.info(f"TLS connection established. Cipher: {writer.get_extra_info('cipher')}")
-        await configure_server(reader, writer)
+        return await producer.key_directory.ping()
+    except Exception as e:
+        logger.error(f"Server health check failed: {e}")
+        return False
 
-        batch_size = 10
-        delay_between_batches = 0.01
-        failed_messages = []
+# Default message source: batches sized and spaced by the producer's pacing controller
+async def batched_messages(producer, num_messages):
+    pacer = producer.pacer
+    batch_start = 0
+    batch_number = 0
+    next_batch_at = time.monotonic()
+    while batch_start < num_messages:
+        pacer.update(producer.pool.write_buffer_pressure() if producer.pool is not None else 0.0)
+        batch_end = min(batch_start + pacer.batch_size, num_messages)
+        batch_number += 1
+        logger.info("Sending batch %d: messages %d-%d", batch_number, batch_start+1, batch_end)
 
-        for batch_start in range(0, num_messages, batch_size):
-            batch_end = min(batch_start + batch_size, num_messages)
-            logger.info(f"Sending batch {batch_start//batch_size + 1}: messages {batch_start+1}-{batch_end}")
+        for i in range(batch_start, batch_end):
+            yield generate_message(producer.client_id)
+        batch_start = batch_end
 
-            for i in range(batch_start, batch_end):
-                message = generate_message()
-                encrypted_messages = await encrypt_message_for_receivers(message, receiver_client_ids)
+        if batch_end < num_messages:
+            # Keep to the schedule, but do not burst to catch up after a stall in the pipeline
+            next_batch_at = max(next_batch_at + pacer.delay, time.monotonic() - pacer.batch_interval)
+            delay = next_batch_at - time.monotonic()
+            if delay > 0:
+                logger.debug("Batch completed, waiting %.4fs before next batch", delay)
+                await asyncio.sleep(delay)
 
-                for encrypted_message in encrypted_messages:
-                    success = await send_message(reader, writer, encrypted_message)
-                    if not success:
-                        logger.warning(f"Message {encrypted_message['message_id']} failed, adding to retry queue")
-                        failed_messages.append(encrypted_message)
+# Send batch of messages; returns how many deliveries failed even after a retry, None if nothing was sent
+async def send_messages_persistent(producer, num_messages=100, messages=None):
+    public_keys = await producer.fetch_all_public_keys()
+    if not public_keys:
+        logger.error("No valid public keys available. Exiting")
+        await producer.close()
+        return None
 
-                await asyncio.sleep(0.000001)
+    logger.info(f"Using receiver_client_ids: {list(public_keys.keys())}")
 
-            if batch_end < num_messages:
-                logger.debug(f"Batch completed, waiting {delay_between_batches}s before next batch")
-                await asyncio.sleep(delay_between_batches)
+    try:
+        await producer.connect()
+        produced = 0
+        async for message in (messages if messages is not None else batched_messages(producer, num_messages)):
+            await producer.publish_message(message)
+            produced += 1
+
+        failed_messages = await producer.flush()
+        for encrypted_message in failed_messages:
+            logger.warning(f"Message {encrypted_message['message_id']} failed, adding to retry queue")
 
+        undelivered = 0
         if failed_messages:
             logger.info(f"Retrying {len(failed_messages)} failed messages")
-            for encrypted_message in failed_messages:
-                await send_message(reader, writer, encrypted_message)
-                await asyncio.sleep(0.01)
+            outcomes = await producer.pool.retry(failed_messages)
+            for encrypted_message, acknowledged in zip(failed_messages, outcomes):
+                if not acknowledged:
+                    undelivered += 1
+                    logger.error(f"Message {encrypted_message['message_id']} could not be delivered")
 
-        logger.info(f"Successfully sent {num_messages} messages (with {len(failed_messages)} retries)")
+        if undelivered:
+            logger.error(f"Sent {produced} messages, but {undelivered} deliveries to receivers failed "
+                         f"(with {len(failed_messages)} retries)")
+        else:
+            logger.info(f"Successfully sent {produced} messages (with {len(failed_messages)} retries)")
+        logger.info(f"Pending store: {producer.pending_messages.stats()}")
+        logger.info(f"TLS handshakes: {producer.ssl_context.handshakes}")
+        if messages is None:
+            logger.info(f"Pacing: {producer.pacer.metrics()}")
+        return undelivered
 
     finally:
-        writer.close()
-        await writer.wait_closed()
+        await producer.close()
         logger.info("Connection closed after sending messages")
 
+# Log-linear latency histogram in the style of HdrHistogram: each power-of-two range is split
+# into 2**sub_bucket_bits buckets, so recording is O(1) and percentiles keep ~1% relative error
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(1, int(seconds * 1_000_000))
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        index = (shift << self.sub_bucket_bits) + (value >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    # Highest value (in microseconds) that falls into the same bucket as the given index
+    def _bucket_value(self, index):
+        shift = index >> self.sub_bucket_bits
+        sub_bucket = index - (shift << self.sub_bucket_bits)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        threshold = max(1, int(self.count * percent / 100 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        to_ms = lambda value: round(value / 1000, 3)
+        return {
+            "count": self.count,
+            "min": to_ms(self.min or 0),
+            "mean": to_ms(self.total / self.count if self.count else 0),
+            "p50": to_ms(self.percentile(50)),
+            "p90": to_ms(self.percentile(90)),
+            "p99": to_ms(self.percentile(99)),
+            "p99.9": to_ms(self.percentile(99.9)),
+            "max": to_ms(self.max),
+        }
+
+# Parse a payload size distribution: fixed:N, uniform:MIN:MAX, exponential:MEAN or choice:A,B,C
+def parse_payload_size(spec):
+    kind, _, args = spec.partition(":")
+    try:
+        if kind == "fixed":
+            size = int(args)
+            return lambda: size
+        if kind == "uniform":
+            low, high = (int(value) for value in args.split(":"))
+            return lambda: random.randint(low, high)
+        if kind == "exponential":
+            mean = float(args)
+            return lambda: max(1, int(random.expovariate(1 / mean)))
+        if kind == "choice":
+            sizes = [int(value) for value in args.split(",")]
+            return lambda: random.choice(sizes)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"invalid payload size distribution: {spec!r}")
+
+# Open-loop message source: message i is due at start + i/rate whether or not earlier messages
+# have been acknowledged. A source that falls behind catches up immediately rather than
+# stretching the schedule, so queueing delay shows up in the measured latency.
+async def open_loop_messages(sender_id, rate, duration, payload_size, intended_times):
+    interval = 1.0 / rate
+    start = time.monotonic()
+    i = 0
+    while i * interval < duration:
+        intended = start + i * interval
+        delay = intended - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = generate_message(sender_id, size=payload_size())
+        intended_times[message["correlation_id"]] = intended
+        yield message
+        i += 1
+
+# Publish at a fixed rate for a fixed duration and report publish-to-ACK latency percentiles
+async def run_load_test(producer, rate, duration, payload_size):
+    histogram = LatencyHistogram()
+    intended_times = {}
+    producer.setup()
+    prefix = len(producer.client_id) + 1
+
+    # message_id is "<sender>-<correlation_id>-<suffix>", one per routing key the message fans out to
+    def on_ack(message_id):
+        intended = intended_times.get(message_id[prefix:prefix + 8])
+        if intended is not None:
+            histogram.record(time.monotonic() - intended)
+
+    producer.ack_listeners.append(on_ack)
+    started = time.monotonic()
+    try:
+        undelivered = await send_messages_persistent(
+            producer,
+            messages=open_loop_messages(producer.client_id, rate, duration, payload_size, intended_times),
+        )
+    finally:
+        producer.ack_listeners.remove(on_ack)
+    elapsed = time.monotonic() - started
+
+    return {
+        "target_rate": rate,
+        "duration_s": duration,
+        "elapsed_s": round(elapsed, 3),
+        "generated": len(intended_times),
+        "acknowledged": histogram.count,
+        "failed": undelivered,
+        # One generated message is published once per routing key it fans out to
+        "achieved_rate": round(len(intended_times) / elapsed, 1) if elapsed else 0,
+        "ack_rate": round(histogram.count / elapsed, 1) if elapsed else 0,
+        "latency_ms": histogram.summary(),
+        "pending": producer.pending_messages.stats(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CipherMQ demo sender")
+    subparsers = parser.add_subparsers(dest="mode")
+    load = subparsers.add_parser("loadgen", help="open-loop load generator with latency percentiles")
+    load.add_argument("--rate", type=float, required=True, help="messages per second")
+    load.add_argument("--duration", type=float, default=10, help="seconds to generate load for")
+    load.add_argument("--payload-size", type=parse_payload_size, default="fixed:256",
+                      help="fixed:N, uniform:MIN:MAX, exponential:MEAN or choice:A,B,C (bytes)")
+    load.add_argument("--concurrency", type=int, default=None, help="publisher connections")
+    load.add_argument("--output", default="-", help="JSON results file, - for stdout")
+    train = subparsers.add_parser("train-dictionary", help="build a compression dictionary from sample payloads")
+    train.add_argument("samples", nargs="+", help="files with one sample payload per line")
+    train.add_argument("--size", type=int, default=16384, help="dictionary size in bytes")
+    train.add_argument("--output", required=True, help="dictionary file to write")
+    return parser.parse_args(argv)
+
 async def main():
+    args = parse_args()
+    try:
+        os.makedirs("logs", exist_ok=True)
+        config = load_config()
+        # The load generator's report goes to stdout, so its console log goes to stderr
+        setup_logging(config, sys.stderr if args.mode == "loadgen" else sys.stdout)
+        producer = CipherMQProducer(config, connections=getattr(args, "concurrency", None))
+    except FileNotFoundError:
+        print("❌ [SENDER] Configuration file 'config.json' not found.")
+        sys.exit(1)
+    except KeyError as e:
+        print(f"❌ [SENDER] Missing key in configuration file: {e}")
+        sys.exit(1)
+
+    if args.mode == "train-dictionary":
+        dictionary = train_compression_dictionary(args.samples, args.size, producer.compression_config.get("algorithm", "zlib"))
+        with open(args.output, "wb") as f:
+            f.write(dictionary)
+        logger.info(f"Wrote {len(dictionary)}-byte compression dictionary {format(zlib.crc32(dictionary), '08x')} to {args.output}")
+        return
+    try:
+        producer.setup()
+    except (OSError, ValueError) as e:
+        print(f"❌ [SENDER] {e}")
+        sys.exit(1)
+    if args.mode == "loadgen":
+        logger.info(f"Starting load generator at {args.rate} msg/s for {args.duration}s")
+        results = await run_load_test(producer, args.rate, args.duration, args.payload_size)
+        output = json.dumps(results, indent=2)
+        if args.output == "-":
+            print(output)
+        else:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+            logger.info(f"Load test results written to {args.output}")
+        return
     logger.info("Starting sender")
-    await send_messages_persistent(num_messages=100)
+    if await send_messages_persistent(producer, num_messages=100) != 0:
+        sys.exit(1)
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -3,16 +3,39 @@ from datetime import datetime, timezone
 import json
 import signal
 import ssl
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import sys
 import time
+import threading
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler
+import queue
+import atexit
 from base64 import b64decode, b64encode
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives import serialization
 from nacl.public import PrivateKey, SealedBox
 import os
+import struct
+import zlib
+import re
+import binascii
+import argparse
+import tracemalloc
+import math
+import hashlib
+# Optional: needed only for messages a sender compressed with zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Configured by load_settings() in the receiver process; decrypt worker processes leave it unconfigured
+logger = logging.getLogger('Receiver')
 
 # Custom filter for logging levels
 class LevelFilter(logging.Filter):
@@ -23,23 +46,115 @@ class LevelFilter(logging.Filter):
     def filter(self, record):
         return record.levelno == self.level
 
+# Handlers whose per-record flush is skipped while the log writer is draining a batch
+class DeferredFlush:
+    deferred = False
+
+    def flush(self):
+        if not self.deferred:
+            super().flush()
+
+class BatchStreamHandler(DeferredFlush, logging.StreamHandler):
+    pass
+
+class BatchRotatingFileHandler(DeferredFlush, RotatingFileHandler):
+    pass
+
+# Hands records to the log writer thread; only the message is merged here, the rest of
+# the formatting and all file I/O happen off the event loop. When the queue is full, records
+# below ERROR are dropped rather than stalling the caller.
+class LogQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.ERROR:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Background thread that writes queued records in batches and flushes each handler once per batch
+class LogWriter:
+    def __init__(self, queue_handler, handlers, batch_size=256):
+        self.queue_handler = queue_handler
+        self.queue = queue_handler.queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.reported_drops = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            dropped = self.queue_handler.dropped
+            if dropped > self.reported_drops:
+                batch.append(logging.makeLogRecord({
+                    "name": "logging", "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Log queue full, dropped {dropped - self.reported_drops} records"
+                }))
+                self.reported_drops = dropped
+            for handler in self.handlers:
+                handler.deferred = True
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.deferred = False
+                handler.flush()
+
 # Initialize logging
 def setup_logging(config):
     logger = logging.getLogger('Receiver')
     logger.setLevel(getattr(logging, config["logging"]["level"]))
+    # Queue mode: the calling thread only enqueues records, a writer thread does the I/O
+    queued = config["logging"].get("queue", False)
+    handlers = []
 
-    console_handler = logging.StreamHandler(sys.stdout)
+    # Console handler
+    console_handler = BatchStreamHandler(sys.stdout)
     console_handler.setFormatter(logging.Formatter(
         '%(asctime)s [%(levelname)s] %(message)s'
     ))
-    logger.addHandler(console_handler)
+    handlers.append(console_handler)
 
+    # File handlers for different log levels
     for level, file_path in [
         (logging.INFO, config["logging"]["info_file_path"]),
         (logging.DEBUG, config["logging"]["debug_file_path"]),
         (logging.ERROR, config["logging"]["error_file_path"])
     ]:
-        handler = RotatingFileHandler(
+        handler = BatchRotatingFileHandler(
             file_path,
             maxBytes=config["logging"]["max_size_mb"] * 1_000_000,
             backupCount=5
@@ -49,57 +164,705 @@ def setup_logging(config):
         handler.setFormatter(logging.Formatter(
             '{"time": "%(asctime)s", "level": "%(levelname)s", "message": "%(message)s"}'
         ))
-        logger.addHandler(handler)
+        handlers.append(handler)
+
+    if queued:
+        queue_handler = LogQueueHandler(queue.Queue(config["logging"].get("queue_size", 10000)))
+        logger.addHandler(queue_handler)
+        LogWriter(queue_handler, handlers, config["logging"].get("batch_size", 256)).start()
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     return logger
 
-# Load configuration
-try:
-    os.makedirs("logs", exist_ok=True)
-    os.makedirs("keys", exist_ok=True)
-    os.makedirs("data", exist_ok=True)
-    with open("config.json", "r") as config_file:
-        config = json.load(config_file)
-    QUEUE_NAME = config["queue_name"]
-    EXCHANGE_NAME = config["exchange_name"]
-    ROUTING_KEY = config["routing_key"]
-    SERVER_ADDRESS = config["server_address"]
-    SERVER_PORT = config["server_port"]
-    TLS_CONFIG = config["tls"]
-    logger = setup_logging(config)
-except FileNotFoundError:
-    print("❌ [RECEIVER] Configuration file 'config.json' not found.")
-    sys.exit(1)
-except KeyError as e:
-    print(f"❌ [RECEIVER] Missing key in configuration file: {e}")
-    sys.exit(1)
+# Extract client_id from client certificate
+def extract_client_id(tls_config):
+    try:
+        with open(tls_config["client_cert_path"], "rb") as cert_file:
+            cert_data = cert_file.read()
+        cert = x509.load_pem_x509_certificate(cert_data, default_backend())
+        cn = cert.subject.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)
+        if not cn:
+            raise ValueError("No Common Name found in client certificate")
+        return cn[0].value
+    except Exception as e:
+        print(f"❌ [RECEIVER] Error extracting client_id from certificate: {e}")
+        sys.exit(1)
 
 # Global variables - queues will be initialized in async context
 message_queue = None
 ack_queue = None
 running = True
-processed_messages = set()
+# key_id -> ChaCha20Poly1305 for sender session keys that were already unsealed
+session_ciphers = OrderedDict()
+session_ciphers_lock = threading.Lock()
+# crc32 id -> dictionary bytes, matching the compression_dict field set by senders
+compression_dictionaries = {}
+# Per decrypt thread: dict_id (None without a dictionary) -> zstandard.ZstdDecompressor, which is not thread-safe
+zstd_local = threading.local()
+decrypt_executor = None
+decrypt_slots = None
+# The server did not understand the hello: connections skip it until this time
+legacy_until = 0.0
 
-# Load keys
-try:
-    with open("keys/receiver_private.key", "r") as key_file:
-        private_key_bytes = b64decode(key_file.read())
-        PRIVATE_KEY = PrivateKey(private_key_bytes)
-    with open("keys/receiver_public.key", "r") as key_file:
-        PUBLIC_KEY_X25519 = x25519.X25519PublicKey.from_public_bytes(b64decode(key_file.read()))
-except Exception as e:
-    logger.error(f"Error loading keys: {e}")
-    sys.exit(1)
-
-# SSL context
-ssl_context = ssl.SSLContext(getattr(ssl, TLS_CONFIG["protocol"]))
-ssl_context.load_verify_locations(TLS_CONFIG["certificate_path"])
-ssl_context.load_cert_chain(
-    certfile=TLS_CONFIG["client_cert_path"],
-    keyfile=TLS_CONFIG["client_key_path"]
+# Load configuration and the settings derived from it. Only the receiver process runs this (from __main__):
+# decrypt worker processes import the module without it and get their settings from init_decrypt_worker().
+def load_settings(path="config.json"):
+    global config, QUEUE_NAME, EXCHANGE_NAME, ROUTING_KEY, SERVER_ADDRESS, SERVER_PORT, TLS_CONFIG, WIRE_FORMAT
+    global CLIENT_ID, CLIENT_ID_BYTES, SESSION_CIPHER_CACHE_SIZE, COMPRESSION_CONFIG, MAX_DECOMPRESSED_SIZE
+    global READ_CHUNK_SIZE, MAX_MESSAGE_SIZE, IDLE_REPORT_INTERVAL, BYTE_PARSE_MIN_SIZE
+    global ACK_BATCH_SIZE, ACK_FLUSH_INTERVAL, DECRYPT_EXECUTOR, DECRYPT_WORKERS, DECRYPT_MAX_IN_FLIGHT
+    global NEGOTIATE, HELLO_TIMEOUT, LEGACY_RECHECK_INTERVAL, PROTOCOL_FEATURES
+    global LATENCY_WINDOW, LATENCY_REPORT_INTERVAL, latency_tracker
+    global DEDUP_SNAPSHOT_PATH, DEDUP_SNAPSHOT_INTERVAL, processed_messages
+    try:
+        os.makedirs("logs", exist_ok=True)
+        os.makedirs("keys", exist_ok=True)
+        os.makedirs("data", exist_ok=True)
+        with open(path, "r") as config_file:
+            config = json.load(config_file)
+        QUEUE_NAME = config["queue_name"]
+        EXCHANGE_NAME = config["exchange_name"]
+        ROUTING_KEY = config["routing_key"]
+        SERVER_ADDRESS = config["server_address"]
+        SERVER_PORT = config["server_port"]
+        TLS_CONFIG = config["tls"]
+        # "text" lines or "binary" frames on the consuming connection
+        WIRE_FORMAT = config.get("wire", {}).get("format", "text")
+        protocol_config = config.get("protocol", {})
+        CLIENT_ID = extract_client_id(TLS_CONFIG)
+        setup_logging(config)
+        logger.info(f"Extracted client_id from certificate: {CLIENT_ID}")
+    except FileNotFoundError:
+        print("❌ [RECEIVER] Configuration file 'config.json' not found.")
+        sys.exit(1)
+    except KeyError as e:
+        print(f"❌ [RECEIVER] Missing key in configuration file: {e}")
+        sys.exit(1)
+
+    CLIENT_ID_BYTES = CLIENT_ID.encode('utf-8')
+    SESSION_CIPHER_CACHE_SIZE = config.get("session_cache_size", 256)
+    COMPRESSION_CONFIG = config.get("compression", {})
+    MAX_DECOMPRESSED_SIZE = int(COMPRESSION_CONFIG.get("max_decompressed_size_mb", 16) * 1_000_000)
+    read_config = config.get("read", {})
+    READ_CHUNK_SIZE = int(read_config.get("chunk_size_kb", 128) * 1024)
+    MAX_MESSAGE_SIZE = int(read_config.get("max_message_size_mb", 64) * 1_000_000)
+    IDLE_REPORT_INTERVAL = read_config.get("idle_report_interval", 60)
+    # Text lines from this size on use the byte-level parser; below it json.loads is at least as fast and the copies are small
+    BYTE_PARSE_MIN_SIZE = int(read_config.get("byte_parse_min_size_kb", 16) * 1024)
+    ack_config = config.get("ack", {})
+    ACK_BATCH_SIZE = ack_config.get("batch_size", 64)
+    ACK_FLUSH_INTERVAL = ack_config.get("flush_interval_ms", 1) / 1000
+    # Decryption runs on a pool of "thread" or "process" workers so the read loop only frames messages;
+    # "inline" decrypts on the event loop. max_in_flight bounds the messages handed to the pool before reading pauses.
+    decrypt_config = config.get("decrypt", {})
+    DECRYPT_EXECUTOR = decrypt_config.get("executor", "thread")
+    DECRYPT_WORKERS = decrypt_config.get("workers", os.cpu_count() or 1)
+    DECRYPT_MAX_IN_FLIGHT = decrypt_config.get("max_in_flight", 256)
+    NEGOTIATE = protocol_config.get("negotiate", True)
+    HELLO_TIMEOUT = protocol_config.get("hello_timeout", 2.0)
+    LEGACY_RECHECK_INTERVAL = protocol_config.get("legacy_recheck_interval", 300)
+    # Features offered in the hello; nothing to offer means no hello at all
+    PROTOCOL_FEATURES = ["binary_frames"] if WIRE_FORMAT == "binary" else []
+    LATENCY_WINDOW = config.get("latency", {}).get("window", 60)
+    LATENCY_REPORT_INTERVAL = config.get("latency", {}).get("report_interval", 10)
+    latency_tracker = LatencyTracker(LATENCY_WINDOW, LATENCY_REPORT_INTERVAL)
+    dedup_config = config.get("dedup", {})
+    DEDUP_SNAPSHOT_PATH = dedup_config.get("snapshot_path", f"data/{QUEUE_NAME}_dedup.bin")
+    DEDUP_SNAPSHOT_INTERVAL = dedup_config.get("snapshot_interval", 30)
+    processed_messages = DedupIndex(
+        dedup_config.get("window", 3600),
+        dedup_config.get("slots", 12),
+        dedup_config.get("max_ids", 1_000_000),
+        dedup_config.get("bloom", {}).get("capacity", 0) if dedup_config.get("bloom", {}).get("enabled", False) else 0,
+        dedup_config.get("bloom", {}).get("error_rate", 0.0001)
+    )
+    load_keys()
+    load_compression_dictionaries(COMPRESSION_CONFIG.get("dictionaries", []))
+
+# Log-linear latency histogram in the style of HdrHistogram: each power-of-two range is split
+# into 2**sub_bucket_bits buckets, so recording is O(1) and percentiles keep ~1% relative error
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(1, int(seconds * 1_000_000))
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        index = (shift << self.sub_bucket_bits) + (value >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    # Highest value (in microseconds) that falls into the same bucket as the given index
+    def _bucket_value(self, index):
+        shift = index >> self.sub_bucket_bits
+        sub_bucket = index - (shift << self.sub_bucket_bits)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        threshold = max(1, int(self.count * percent / 100 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        to_ms = lambda value: round(value / 1000, 3)
+        return {
+            "count": self.count,
+            "min": to_ms(self.min or 0),
+            "mean": to_ms(self.total / self.count if self.count else 0),
+            "p50": to_ms(self.percentile(50)),
+            "p90": to_ms(self.percentile(90)),
+            "p99": to_ms(self.percentile(99)),
+            "p99.9": to_ms(self.percentile(99.9)),
+            "max": to_ms(self.max),
+        }
+
+# Sender-to-receiver latency: one histogram per report interval, the last `window` seconds are kept
+class LatencyTracker:
+    def __init__(self, window=60, interval=10):
+        self.window = window
+        self.interval = interval
+        self.slots = deque()
+        self.overall = LatencyHistogram()
+
+    def record(self, seconds):
+        now = time.monotonic()
+        if not self.slots or now - self.slots[-1][0] >= self.interval:
+            self.slots.append((now, LatencyHistogram()))
+            while now - self.slots[0][0] >= self.window:
+                self.slots.popleft()
+        self.slots[-1][1].record(seconds)
+        self.overall.record(seconds)
+
+    def recent(self) -> LatencyHistogram:
+        now = time.monotonic()
+        histogram = LatencyHistogram()
+        for started, slot in self.slots:
+            if now - started < self.window:
+                histogram.merge(slot)
+        return histogram
+
+def format_latency(summary: dict) -> str:
+    return (f"count={summary['count']} p50={summary['p50']}ms p90={summary['p90']}ms "
+            f"p99={summary['p99']}ms p99.9={summary['p99.9']}ms max={summary['max']}ms")
+
+# Bloom filter over message ids: fixed size for `capacity` ids at the given false-positive rate
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # Double hashing over one 128-bit digest
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+# Message ids seen recently, for duplicate suppression with bounded memory.
+# Ids live in a ring of hash sets, one per window/slots seconds (a slot also closes once it holds max_ids/slots ids);
+# the oldest slot is dropped when it leaves the window or the ring holds more than max_ids. A lookup checks every
+# slot, which is O(1) for a fixed slot count. With a bloom capacity, dropped ids move into two generations of
+# Bloom filters, so suppression reaches further back at a fixed cost; a false positive there makes a new message
+# look like a duplicate, which is why it is off by default.
+class DedupIndex:
+    def __init__(self, window=3600, slots=12, max_ids=1_000_000, bloom_capacity=0, bloom_error_rate=0.0001):
+        self.window = window
+        self.slot_count = max(1, slots)
+        self.slot_interval = window / self.slot_count
+        self.max_ids = max_ids
+        self.slot_limit = max(1, max_ids // self.slot_count)
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        # (wall-clock start, set of message ids), oldest first; wall clock so snapshots stay valid across restarts
+        self.slots = deque()
+        self.size = 0
+        self.blooms = deque(maxlen=2)
+        self.dirty = False
+
+    def __contains__(self, message_id):
+        for _, ids in self.slots:
+            if message_id in ids:
+                return True
+        return any(message_id in bloom for bloom in self.blooms)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, message_id):
+        now = time.time()
+        if not self.slots or now - self.slots[-1][0] >= self.slot_interval or len(self.slots[-1][1]) >= self.slot_limit:
+            self.slots.append((now, set()))
+            self.expire(now)
+        ids = self.slots[-1][1]
+        if message_id not in ids:
+            ids.add(message_id)
+            self.size += 1
+            self.dirty = True
+        while self.size > self.max_ids and len(self.slots) > 1:
+            self._drop_oldest()
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        while self.slots and now - self.slots[0][0] >= self.window:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        _, ids = self.slots.popleft()
+        self.size -= len(ids)
+        self.dirty = True
+        if self.bloom_capacity:
+            for message_id in ids:
+                if not self.blooms or self.blooms[-1].count >= self.bloom_capacity:
+                    self.blooms.append(BloomFilter(self.bloom_capacity, self.bloom_error_rate))
+                self.blooms[-1].add(message_id)
+
+    # Cheap copy of the index for encode_dedup_snapshot(). Only the newest slot and Bloom filter still change,
+    # so they are copied; older slots are shared, which is safe because closed slots are only ever dropped.
+    def snapshot_state(self):
+        self.dirty = False
+        slots = list(self.slots)
+        if slots:
+            slots[-1] = (slots[-1][0], set(slots[-1][1]))
+        blooms = [(bloom.size, bloom.hashes, bloom.count, bytes(bloom.bits)) for bloom in self.blooms]
+        return slots, blooms
+
+    def snapshot(self) -> bytes:
+        return encode_dedup_snapshot(*self.snapshot_state())
+
+    # Load a snapshot; expired slots are dropped and filters built with different settings are ignored
+    def restore(self, data: bytes):
+        slots, blooms = decode_dedup_snapshot(data)
+        self.slots = deque(slots)
+        self.size = sum(len(ids) for _, ids in self.slots)
+        self.blooms.clear()
+        if self.bloom_capacity:
+            for size, hashes, count, bits in blooms:
+                bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+                if (bloom.size, bloom.hashes) == (size, hashes) and len(bits) == len(bloom.bits):
+                    bloom.bits = bytearray(bits)
+                    bloom.count = count
+                    self.blooms.append(bloom)
+        self.expire()
+        while self.size > self.max_ids and len(self.slots) > 1:
+            self._drop_oldest()
+        self.dirty = False
+
+# Dedup snapshot file: magic, version, slot and filter counts, then each slot as its start time and its
+# newline-separated ids, then each Bloom filter's parameters and bits. Message ids never contain whitespace,
+# since the text protocol splits on it.
+DEDUP_SNAPSHOT_MAGIC = b"CMQD"
+DEDUP_SNAPSHOT_VERSION = 2
+DEDUP_SNAPSHOT_HEADER = struct.Struct(">4sBII")
+DEDUP_SLOT_HEADER = struct.Struct(">dII")      # start time, id count, byte length
+DEDUP_BLOOM_HEADER = struct.Struct(">QIQI")    # size in bits, hashes, count, byte length
+
+def encode_dedup_snapshot(slots, blooms) -> bytes:
+    parts = [DEDUP_SNAPSHOT_HEADER.pack(DEDUP_SNAPSHOT_MAGIC, DEDUP_SNAPSHOT_VERSION, len(slots), len(blooms))]
+    for started, ids in slots:
+        data = "\n".join(ids).encode('utf-8')
+        parts.append(DEDUP_SLOT_HEADER.pack(started, len(ids), len(data)))
+        parts.append(data)
+    for size, hashes, count, bits in blooms:
+        parts.append(DEDUP_BLOOM_HEADER.pack(size, hashes, count, len(bits)))
+        parts.append(bits)
+    return b"".join(parts)
+
+def decode_dedup_snapshot(data: bytes):
+    magic, version, slot_count, bloom_count = DEDUP_SNAPSHOT_HEADER.unpack_from(data)
+    if magic != DEDUP_SNAPSHOT_MAGIC or version != DEDUP_SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported dedup snapshot version {version}")
+    offset = DEDUP_SNAPSHOT_HEADER.size
+    slots = []
+    for _ in range(slot_count):
+        started, count, length = DEDUP_SLOT_HEADER.unpack_from(data, offset)
+        offset += DEDUP_SLOT_HEADER.size
+        ids = set(data[offset:offset + length].decode('utf-8').split("\n")) if count else set()
+        if len(ids) != count:
+            raise ValueError("Corrupt dedup snapshot")
+        slots.append((started, ids))
+        offset += length
+    blooms = []
+    for _ in range(bloom_count):
+        size, hashes, count, length = DEDUP_BLOOM_HEADER.unpack_from(data, offset)
+        offset += DEDUP_BLOOM_HEADER.size
+        blooms.append((size, hashes, count, data[offset:offset + length]))
+        offset += length
+    return slots, blooms
+
+def write_dedup_snapshot(data: bytes):
+    os.makedirs(os.path.dirname(DEDUP_SNAPSHOT_PATH) or ".", exist_ok=True)
+    temp_path = DEDUP_SNAPSHOT_PATH + ".tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, DEDUP_SNAPSHOT_PATH)
+
+def encode_and_write_dedup_snapshot(slots, blooms):
+    write_dedup_snapshot(encode_dedup_snapshot(slots, blooms))
+
+def load_dedup_snapshot():
+    try:
+        with open(DEDUP_SNAPSHOT_PATH, "rb") as snapshot_file:
+            processed_messages.restore(snapshot_file.read())
+        logger.info(f"Loaded {len(processed_messages)} message ids from {DEDUP_SNAPSHOT_PATH}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Ignoring unreadable dedup snapshot {DEDUP_SNAPSHOT_PATH}: {e}")
+
+# Final snapshot on the way out: main() saves it after SIGINT or SIGTERM, atexit on any other clean exit.
+# A hard kill (SIGKILL, a crash) loses what changed since the last periodic snapshot.
+def save_dedup_snapshot():
+    if DEDUP_SNAPSHOT_PATH and processed_messages.dirty:
+        try:
+            write_dedup_snapshot(processed_messages.snapshot())
+        except Exception as e:
+            logger.error(f"Error saving dedup snapshot: {e}")
+
+# Periodically persist the dedup index; only the state copy happens on the event loop,
+# encoding and writing the file run in the executor
+async def snapshot_dedup():
+    loop = asyncio.get_running_loop()
+    while running:
+        await asyncio.sleep(DEDUP_SNAPSHOT_INTERVAL)
+        processed_messages.expire()
+        if not processed_messages.dirty:
+            continue
+        try:
+            await loop.run_in_executor(None, encode_and_write_dedup_snapshot, *processed_messages.snapshot_state())
+        except Exception as e:
+            logger.error(f"Error saving dedup snapshot: {e}")
+
+# Load this receiver's key pair
+def load_keys():
+    global PRIVATE_KEY, UNSEAL_BOX, PUBLIC_KEY_X25519
+    try:
+        with open("keys/receiver_private.key", "r") as key_file:
+            private_key_bytes = b64decode(key_file.read())
+            PRIVATE_KEY = PrivateKey(private_key_bytes)
+            UNSEAL_BOX = SealedBox(PRIVATE_KEY)
+        with open("keys/receiver_public.key", "r") as key_file:
+            PUBLIC_KEY_X25519 = x25519.X25519PublicKey.from_public_bytes(b64decode(key_file.read()))
+    except Exception as e:
+        logger.error(f"Error loading keys: {e}")
+        sys.exit(1)
+
+# Load compression dictionaries shared with senders
+def load_compression_dictionaries(paths):
+    for dictionary_path in paths:
+        try:
+            with open(dictionary_path, "rb") as dictionary_file:
+                dictionary = dictionary_file.read()
+            compression_dictionaries[format(zlib.crc32(dictionary), '08x')] = dictionary
+        except OSError as e:
+            logger.error(f"Error loading compression dictionary {dictionary_path}: {e}")
+            sys.exit(1)
+
+# Undo the sender's optional compression stage; output is capped to guard against decompression bombs
+def decompress_content(data: bytes, algorithm, dict_id=None) -> bytes:
+    if algorithm is None:
+        return data
+    dictionary = None
+    if dict_id is not None:
+        dictionary = compression_dictionaries.get(dict_id)
+        if dictionary is None:
+            raise ValueError(f"Unknown compression dictionary {dict_id}")
+    if algorithm == "zlib":
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        result = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Decompressed message exceeds {MAX_DECOMPRESSED_SIZE} bytes")
+        return result
+    if algorithm == "zstd":
+        if zstandard is None:
+            raise ValueError("Message is zstd-compressed but zstandard is not installed")
+        decompressors = getattr(zstd_local, "decompressors", None)
+        if decompressors is None:
+            decompressors = zstd_local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            decompressor = decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        with decompressor.stream_reader(data) as reader:
+            result = reader.read(MAX_DECOMPRESSED_SIZE + 1)
+        if len(result) > MAX_DECOMPRESSED_SIZE:
+            raise ValueError(f"Decompressed message exceeds {MAX_DECOMPRESSED_SIZE} bytes")
+        return result
+    raise ValueError(f"Unsupported compression {algorithm}")
+
+# Binary frames: a type byte and payload length, then the payload
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_PUBLISH = 1   # client -> server
+FRAME_ACK = 2       # server -> publisher, consumer -> server; payload is the message_id
+FRAME_ERROR = 3     # server -> client; payload is the error text
+FRAME_MESSAGE = 4   # server -> consumer; payload is the envelope
+FRAME_COMMAND = 5   # text command or response (consume, heartbeat, ...)
+
+# Binary envelope written by senders: every fixed-size field in one header, then the message_id and
+# receiver_client_id, one (id length, id, sealed key) entry per recipient, and the ciphertext.
+# Header: version, flags, compression, recipient count, sent_timestamp, key_id, compression_dict,
+# nonce, enc_session_key, message_id length, receiver_client_id length, ciphertext length
+ENVELOPE_HEADER = struct.Struct(">BBBBd8sI12s80sHHI")
+ENVELOPE_VERSION = 1
+ENVELOPE_KEY_ID = 0x01
+ENVELOPE_COMPRESSION_DICT = 0x02
+ENVELOPE_SENT_TIMESTAMP = 0x04
+COMPRESSION_NAMES = {0: None, 1: "zlib", 2: "zstd"}
+SEALED_KEY_SIZE = 80
+
+def build_frame(frame_type, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+# Hello exchange at connection setup: the client lists the protocol features it can use and the server answers
+# "capabilities" with the ones it also supports, which are then enabled for this connection only.
+# Returns that set, or None when the server answered with anything else (a server that predates the hello).
+# A server that does not answer at all raises asyncio.TimeoutError.
+async def negotiate_features(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, features, timeout=2.0):
+    writer.write(f"hello {' '.join(features)}\n".encode('utf-8'))
+    await writer.drain()
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        raise ConnectionError("Connection closed during the hello exchange")
+    response = line.decode('utf-8').split()
+    if response[:1] != ["capabilities"]:
+        return None
+    return set(response[1:]) & set(features)
+
+def mark_legacy_server(reason):
+    global legacy_until
+    legacy_until = time.monotonic() + LEGACY_RECHECK_INTERVAL
+    logger.warning(f"Server does not negotiate protocol features ({reason}); using the text protocol "
+                   f"for the next {LEGACY_RECHECK_INTERVAL}s")
+
+# Ask the server to switch this connection to binary frames; it stays on text lines if the server declines
+async def request_binary_frames(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout=10.0) -> bool:
+    writer.write(b"frames binary\n")
+    await writer.drain()
+    response = (await asyncio.wait_for(reader.readline(), timeout)).decode('utf-8').strip()
+    if response == "OK binary":
+        return True
+    logger.warning(f"Server declined binary frames ({response}), using the text protocol")
+    return False
+
+# Fields of a binary envelope, read in place; only this receiver's sealed key is picked from the recipients
+def decode_envelope(payload: bytes):
+    view = memoryview(payload)
+    (version, flags, compression, recipient_count, sent_timestamp, key_id, dict_id, nonce, enc_session_key,
+     message_id_length, receiver_length, ciphertext_length) = ENVELOPE_HEADER.unpack_from(view)
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    if compression not in COMPRESSION_NAMES:
+        raise ValueError(f"Unsupported compression code {compression}")
+    offset = ENVELOPE_HEADER.size
+    message_id = str(view[offset:offset + message_id_length], 'utf-8')
+    offset += message_id_length + receiver_length
+    if recipient_count:
+        enc_session_key = None
+        for _ in range(recipient_count):
+            id_length = view[offset]
+            offset += 1
+            if view[offset:offset + id_length] == CLIENT_ID_BYTES:
+                enc_session_key = bytes(view[offset + id_length:offset + id_length + SEALED_KEY_SIZE])
+            offset += id_length + SEALED_KEY_SIZE
+    ciphertext = view[offset:offset + ciphertext_length]
+    if len(ciphertext) != ciphertext_length:
+        raise ValueError("Truncated envelope")
+    return message_id, {
+        "nonce": nonce,
+        "ciphertext": ciphertext,
+        "enc_session_key": enc_session_key,
+        "key_id": key_id.hex() if flags & ENVELOPE_KEY_ID else None,
+        "compression": COMPRESSION_NAMES[compression],
+        "compression_dict": format(dict_id, '08x') if flags & ENVELOPE_COMPRESSION_DICT else None,
+        "sent_timestamp": sent_timestamp if flags & ENVELOPE_SENT_TIMESTAMP else None,
+    }
+
+# Fields of a "Message: <id> <json>" line, base64 decoded, going through str and json.loads.
+# Used for lines the byte-level parser below does not handle.
+def parse_text_message_json(message):
+    if not isinstance(message, str):
+        message = bytes(message).decode('utf-8')
+    parts = message.strip()[len("Message:"):].strip().split(' ', 1)
+    if len(parts) < 2:
+        raise ValueError("Invalid message format")
+    message_id, message_str = parts
+    message_data = json.loads(message_str)
+    # Multi-recipient messages carry one sealed key per receiver
+    recipients = message_data.get("recipients")
+    if recipients is not None:
+        enc_session_key = b64decode(recipients[CLIENT_ID]) if CLIENT_ID in recipients else None
+    else:
+        enc_session_key = b64decode(message_data["enc_session_key"])
+    return message_id, {
+        "nonce": b64decode(message_data["nonce"]),
+        "ciphertext": b64decode(message_data["ciphertext"]),
+        "enc_session_key": enc_session_key,
+        "key_id": message_data.get("key_id"),
+        "compression": message_data.get("compression"),
+        "compression_dict": message_data.get("compression_dict"),
+        "sent_timestamp": message_data.get("sent_timestamp"),
+    }
+
+MESSAGE_LINE = re.compile(rb"\s*Message:\s*(\S+)\s+")
+# Top-level keys the receiver uses, followed by their value
+MESSAGE_FIELD = re.compile(
+    rb'"(nonce|ciphertext|enc_session_key|key_id|compression|compression_dict|sent_timestamp|recipients)"\s*:\s*'
 )
-ssl_context.verify_mode = getattr(ssl, TLS_CONFIG["verify_mode"])
-ssl_context.check_hostname = TLS_CONFIG["check_hostname"]
+# Single-byte literal searches run at memory speed, unlike a character class spanning a long base64 value
+QUOTE = re.compile(rb'"')
+BACKSLASH = re.compile(rb"\\")
+JSON_NUMBER = re.compile(rb"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+RECIPIENT_ENTRY = re.compile(rb'\s*"([^"\\]*)"\s*:\s*"([^"\\]*)"\s*([,}])')
+BASE64_FIELDS = ("nonce", "ciphertext", "enc_session_key")
+
+# Fields of a "Message: <id> <json>" line, parsed on the raw bytes: the regexes only record where each value sits
+# in the line, and base64 is decoded straight from memoryview slices of it, so the only copies made are the
+# decoded fields themselves (the standard library cannot decode into a caller's buffer). Values with escapes or
+# an unexpected shape fall back to parse_text_message_json.
+def parse_text_message(line):
+    view = memoryview(line)
+    match = MESSAGE_LINE.match(view)
+    if match is None:
+        return parse_text_message_json(line)
+    spans = {}
+    recipient_key = None
+    position = match.end()
+    while True:
+        field = MESSAGE_FIELD.search(view, position)
+        if field is None:
+            break
+        name = field.group(1).decode('ascii')
+        position = field.end()
+        first = view[position:position + 1]
+        if first == b'"':
+            # Base64, ids and algorithm names need no escapes; a string that has any takes the json path
+            closing = QUOTE.search(view, position + 1)
+            if closing is None or BACKSLASH.search(view, position + 1, closing.start()) is not None:
+                return parse_text_message_json(line)
+            spans[name] = (position + 1, closing.start())
+            position = closing.end()
+        elif first == b"{" and name == "recipients":
+            spans[name] = None
+            position += 1
+            if RECIPIENT_ENTRY.match(view, position) is None and re.match(rb"\s*}", view[position:]) is None:
+                return parse_text_message_json(line)
+            while True:
+                entry = RECIPIENT_ENTRY.match(view, position)
+                if entry is None:
+                    break
+                position = entry.end()
+                if entry.group(1) == CLIENT_ID_BYTES:
+                    recipient_key = entry.span(2)
+                if entry.group(3) == b"}":
+                    break
+        elif view[position:position + 4] == b"null":
+            spans[name] = None
+            position += 4
+        else:
+            number = JSON_NUMBER.match(view, position)
+            if number is None:
+                return parse_text_message_json(line)
+            spans[name] = float(number.group())
+            position = number.end()
+
+    if "recipients" in spans:
+        spans["enc_session_key"] = recipient_key
+    if spans.get("nonce") is None or spans.get("ciphertext") is None or "enc_session_key" not in spans:
+        raise ValueError("Message is missing nonce, ciphertext or session key")
+    fields = {}
+    for name in ("nonce", "ciphertext", "enc_session_key", "key_id", "compression", "compression_dict"):
+        span = spans.get(name)
+        if span is None:
+            fields[name] = None
+        elif name in BASE64_FIELDS:
+            fields[name] = binascii.a2b_base64(view[span[0]:span[1]])
+        else:
+            fields[name] = str(view[span[0]:span[1]], 'utf-8')
+    fields["sent_timestamp"] = spans.get("sent_timestamp")
+    return match.group(1).decode('utf-8'), fields
+
+# SSL context that offers the last session the server issued when reconnecting,
+# so reconnects after a broker restart or network blip resume instead of a full mTLS handshake
+class ResumingSSLContext(ssl.SSLContext):
+    def __init__(self, protocol, resumption=True):
+        super().__init__()
+        self.resumption = resumption
+        # server_hostname -> ssl.SSLSession
+        self.sessions = {}
+        self.handshakes = {"full": 0, "resumed": 0, "full_ms": 0.0, "resumed_ms": 0.0}
+
+    # asyncio creates its SSLObject through wrap_bio, which is the only place a session can be injected
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and self.resumption and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    # TLS 1.3 session tickets arrive after the handshake, so call this once the server has sent data
+    def remember_session(self, writer, server_hostname="localhost"):
+        ssl_object = writer.get_extra_info('ssl_object')
+        session = ssl_object.session if ssl_object is not None else None
+        if session is not None and session.has_ticket:
+            self.sessions[server_hostname] = session
+
+    # Count the handshake of a newly opened connection; returns True if the session was resumed
+    def record_handshake(self, writer, seconds) -> bool:
+        ssl_object = writer.get_extra_info('ssl_object')
+        kind = "resumed" if ssl_object is not None and ssl_object.session_reused else "full"
+        self.handshakes[kind] += 1
+        self.handshakes[f"{kind}_ms"] = round(self.handshakes[f"{kind}_ms"] + seconds * 1000, 3)
+        return kind == "resumed"
+
+# SSL context, created by main()
+ssl_context = None
+
+def create_ssl_context(tls_config) -> ResumingSSLContext:
+    context = ResumingSSLContext(getattr(ssl, tls_config["protocol"]), tls_config.get("session_resumption", True))
+    context.load_verify_locations(tls_config["certificate_path"])
+    context.load_cert_chain(
+        certfile=tls_config["client_cert_path"],
+        keyfile=tls_config["client_key_path"]
+    )
+    context.verify_mode = getattr(ssl, tls_config["verify_mode"])
+    context.check_hostname = tls_config["check_hostname"]
+    return context
+
 # Register public key with server
 async def register_public_key(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
     public_key_b64 = b64encode(PUBLIC_KEY_X25519.public_bytes(
@@ -112,100 +875,226 @@ async def register_public_key(reader: asyncio.StreamReader, writer: asyncio.Stre
     response = (await reader.readline()).decode('utf-8').strip()
     logger.info(f"Server response for public key registration: {response}")
     return response == "Public key registered"
-# Configure server (declare queue, exchange, and bind)
+# Configure server (declare queue, exchange, and bind) in one pipelined batch; the server answers in order
 async def configure_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    command = f"declare_queue {QUEUE_NAME}\n"
-    writer.write(command.encode('utf-8'))
+    commands = [
+        (f"declare_queue {QUEUE_NAME}", "queue declaration"),
+        (f"declare_exchange {EXCHANGE_NAME}", "exchange declaration"),
+        (f"bind {QUEUE_NAME} {EXCHANGE_NAME} {ROUTING_KEY}", "binding"),
+    ]
+    writer.write("".join(f"{command}\n" for command, _ in commands).encode('utf-8'))
     await writer.drain()
-    response = (await reader.readline()).decode('utf-8').strip()
-    logger.info(f"Server response for queue declaration: {response}")
 
-    command = f"declare_exchange {EXCHANGE_NAME}\n"
-    writer.write(command.encode('utf-8'))
-    await writer.drain()
-    response = (await reader.readline()).decode('utf-8').strip()
-    logger.info(f"Server response for exchange declaration: {response}")
+    for _, label in commands:
+        response = (await reader.readline()).decode('utf-8').strip()
+        logger.info(f"Server response for {label}: {response}")
 
-    command = f"bind {QUEUE_NAME} {EXCHANGE_NAME} {ROUTING_KEY}\n"
-    writer.write(command.encode('utf-8'))
-    await writer.drain()
-    response = (await reader.readline()).decode('utf-8').strip()
-    logger.info(f"Server response for binding: {response}")
-
-async def ack_sender_worker(writer: asyncio.StreamWriter):
+# Coalesced ACKs: once an id is queued, take every id already waiting and, if that is fewer than ACK_BATCH_SIZE,
+# wait ACK_FLUSH_INTERVAL once for more. The batch goes out as one write and one drain; each id is still its own
+# ack command. Ids that could not be sent go back on the queue for the next connection.
+async def ack_sender_worker(writer: asyncio.StreamWriter, binary=False):
     while running:
+        batch = []
         try:
-            message_id = await asyncio.wait_for(ack_queue.get(), timeout=0.5)
-            
+            batch.append(await ack_queue.get())
+            take_queued_acks(batch)
+            if len(batch) < ACK_BATCH_SIZE and ACK_FLUSH_INTERVAL > 0:
+                await asyncio.sleep(ACK_FLUSH_INTERVAL)
+                take_queued_acks(batch)
+
             if writer.is_closing():
                 logger.warning("Writer closed, stopping ACK sender")
+                requeue_acks(batch)
                 break
-            
-            command = f"ack {message_id}\n"
-            writer.write(command.encode('utf-8'))
+
+            if binary:
+                data = b"".join(build_frame(FRAME_ACK, message_id.encode('utf-8')) for message_id in batch)
+            else:
+                data = "".join(f"ack {message_id}\n" for message_id in batch).encode('utf-8')
+            writer.write(data)
             await writer.drain()
-            
-            logger.debug(f"Sent ACK for {message_id}")
-            ack_queue.task_done()
-            
-        except asyncio.TimeoutError:
-            continue
+
+            logger.debug("Sent %d ACKs", len(batch))
+            for _ in batch:
+                ack_queue.task_done()
+
+        except asyncio.CancelledError:
+            requeue_acks(batch)
+            raise
         except Exception as e:
             logger.error(f"Error in ACK sender: {e}")
+            requeue_acks(batch)
             await asyncio.sleep(0.1)
 
-async def process_message(message: str):
-    message = message.strip()
-    
-    if not message or not message.startswith("Message:"):
+def take_queued_acks(batch):
+    while len(batch) < ACK_BATCH_SIZE and not ack_queue.empty():
+        batch.append(ack_queue.get_nowait())
+
+def requeue_acks(batch):
+    for message_id in batch:
+        ack_queue.task_done()
+        ack_queue.put_nowait(message_id)
+
+# A received line as bytes or a memoryview into the read buffer; anything but a message is ignored
+async def process_message(message):
+    if MESSAGE_LINE.match(message) is None:
         return
-        
+    await submit_decrypt("line", message)
+
+async def process_frame(payload: bytes):
+    await submit_decrypt("frame", payload)
+
+# Decrypt worker processes import this module without running load_settings(); under spawn (the default on
+# Windows) that is a fresh interpreter, so the key and the settings decrypt_received() needs are passed in here
+def decrypt_worker_settings() -> dict:
+    return {
+        "client_id": CLIENT_ID,
+        "private_key": bytes(PRIVATE_KEY),
+        "dictionaries": compression_dictionaries,
+        "max_decompressed_size": MAX_DECOMPRESSED_SIZE,
+        "session_cache_size": SESSION_CIPHER_CACHE_SIZE,
+        "byte_parse_min_size": BYTE_PARSE_MIN_SIZE,
+    }
+
+def init_decrypt_worker(settings):
+    global CLIENT_ID, CLIENT_ID_BYTES, UNSEAL_BOX, MAX_DECOMPRESSED_SIZE, SESSION_CIPHER_CACHE_SIZE, BYTE_PARSE_MIN_SIZE
+    CLIENT_ID = settings["client_id"]
+    CLIENT_ID_BYTES = CLIENT_ID.encode('utf-8')
+    UNSEAL_BOX = SealedBox(PrivateKey(settings["private_key"]))
+    compression_dictionaries.update(settings["dictionaries"])
+    MAX_DECOMPRESSED_SIZE = settings["max_decompressed_size"]
+    SESSION_CIPHER_CACHE_SIZE = settings["session_cache_size"]
+    BYTE_PARSE_MIN_SIZE = settings["byte_parse_min_size"]
+
+def create_decrypt_executor():
+    if DECRYPT_EXECUTOR == "process":
+        return ProcessPoolExecutor(max_workers=DECRYPT_WORKERS,
+                                   initializer=init_decrypt_worker, initargs=(decrypt_worker_settings(),))
+    if DECRYPT_EXECUTOR == "thread":
+        return ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix="decrypt")
+    return None
+
+# message_id of a received message without decoding the rest, so duplicates skip the decrypt workers;
+# None if it cannot be read, in which case the worker reports the malformed message
+def peek_message_id(kind, data):
     try:
-        parts = message[len("Message:"):].strip().split(' ', 1)
-        if len(parts) < 2:
-            logger.error(f"Invalid message format")
-            return
-            
-        message_id, message_str = parts
-        
-        if message_id in processed_messages:
-            logger.debug(f"Duplicate message {message_id}")
+        if kind == "line":
+            match = MESSAGE_LINE.match(data)
+            return match.group(1).decode('utf-8') if match else None
+        length = ENVELOPE_HEADER.unpack_from(data)[9]
+        return str(data[ENVELOPE_HEADER.size:ENVELOPE_HEADER.size + length], 'utf-8')
+    except (struct.error, UnicodeDecodeError):
+        return None
+
+# A redelivered message was already stored; acknowledge it again so the broker stops resending it
+def acknowledge_duplicate(message_id):
+    logger.debug("Duplicate message %s", message_id)
+    ack_queue.put_nowait(message_id)
+
+# Hand a received message to the decrypt workers; waits only while max_in_flight messages are being decrypted
+async def submit_decrypt(kind, data):
+    message_id = peek_message_id(kind, data)
+    if message_id is not None and message_id in processed_messages:
+        acknowledge_duplicate(message_id)
+        return
+    await decrypt_slots.acquire()
+    if DECRYPT_EXECUTOR == "process":
+        # Slices of the read buffer cannot be pickled; worker processes get their own copy
+        data = bytes(data)
+    if decrypt_executor is None:
+        try:
+            result = decrypt_received(kind, data)
+        except Exception as e:
+            logger.error(str(e))
             return
-            
-        message_data = json.loads(message_str)
-        
-        # Extract components
-        enc_session_key = b64decode(message_data["enc_session_key"])
-        nonce = b64decode(message_data["nonce"])
-        ciphertext_with_tag = b64decode(message_data["ciphertext"])
-        
-        # Decrypt session key
-        sealed_box = SealedBox(PRIVATE_KEY)
-        session_key = sealed_box.decrypt(enc_session_key)
-        
+        finally:
+            decrypt_slots.release()
+        complete_decrypt(result)
+        return
+    future = asyncio.get_running_loop().run_in_executor(decrypt_executor, decrypt_received, kind, data)
+    future.add_done_callback(decrypt_done)
+
+def decrypt_done(future):
+    decrypt_slots.release()
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error(str(error))
+        return
+    complete_decrypt(future.result())
+
+# Store a decrypted message and queue its ACK, in the order decryption finishes
+def complete_decrypt(result):
+    message_id, content, sent_timestamp = result
+    if message_id in processed_messages:
+        acknowledge_duplicate(message_id)
+        return
+    record = {"content": content}
+
+    # End-to-end latency from message creation on the sender; wall clocks, so skew between hosts shows up here
+    if isinstance(sent_timestamp, (int, float)):
+        latency = datetime.now(timezone.utc).timestamp() - sent_timestamp
+        latency_tracker.record(latency)
+        record["latency_ms"] = round(latency * 1000, 3)
+
+    # Store decrypted message
+    processed_messages.add(message_id)
+    message_queue.put_nowait((message_id, record))
+
+    # Add ACK to queue
+    ack_queue.put_nowait(message_id)
+
+    logger.info("Processed and decrypted message %s", message_id)
+
+# Parse and decrypt one message on a decrypt worker: kind is "line" for a "Message: ..." line or "frame" for a
+# binary envelope. Returns (message_id, content, sent_timestamp); failures are raised for the event loop to log.
+def decrypt_received(kind, data):
+    try:
+        if kind == "frame":
+            message_id, fields = decode_envelope(data)
+        elif len(data) >= BYTE_PARSE_MIN_SIZE:
+            message_id, fields = parse_text_message(data)
+        else:
+            message_id, fields = parse_text_message_json(data)
+    except Exception as e:
+        raise ValueError(f"Invalid message{' frame' if kind == 'frame' else ''}: {e}") from None
+    try:
+        # Messages in a sender session share one session key; only unseal it the first time
+        key_id = fields["key_id"]
+        cipher = None
+        if key_id:
+            with session_ciphers_lock:
+                cipher = session_ciphers.get(key_id)
+                if cipher is not None:
+                    session_ciphers.move_to_end(key_id)
+        if cipher is None:
+            enc_session_key = fields["enc_session_key"]
+            if enc_session_key is None:
+                raise ValueError(f"no session key for {CLIENT_ID}")
+
+            # Decrypt session key
+            session_key = UNSEAL_BOX.decrypt(enc_session_key)
+            cipher = ChaCha20Poly1305(session_key)
+            if key_id:
+                with session_ciphers_lock:
+                    session_ciphers[key_id] = cipher
+                    if len(session_ciphers) > SESSION_CIPHER_CACHE_SIZE:
+                        session_ciphers.popitem(last=False)
+
         # Decrypt message
-        cipher = ChaCha20Poly1305(session_key)
-        plaintext = cipher.decrypt(nonce, ciphertext_with_tag, None)
-        decrypted_message = plaintext.decode('utf-8')
-        
-        # Store decrypted message
-        processed_messages.add(message_id)
-        await message_queue.put((message_id, {"content": decrypted_message}))
-        
-        # Add ACK to queue
-        await ack_queue.put(message_id)
-        
-        logger.info(f"Processed and decrypted message {message_id}")
-            
+        plaintext = cipher.decrypt(fields["nonce"], fields["ciphertext"], None)
+        plaintext = decompress_content(plaintext, fields["compression"], fields["compression_dict"])
+        return message_id, plaintext.decode('utf-8'), fields["sent_timestamp"]
     except Exception as e:
-        logger.error(f"Error processing message {message_id}: {e}")
+        raise ValueError(f"Error processing message {message_id}: {e}") from None
 
 # افزودن تابع send_heartbeat
-async def send_heartbeat(writer: asyncio.StreamWriter, interval: int = 30):
+async def send_heartbeat(writer: asyncio.StreamWriter, interval: int = 30, binary=False):
     global running
     while running and not writer.is_closing():
         try:
-            writer.write(b"heartbeat\n")
+            writer.write(build_frame(FRAME_COMMAND, b"heartbeat") if binary else b"heartbeat\n")
             await writer.drain()
             logger.debug("Sent heartbeat")
             await asyncio.sleep(interval)
@@ -213,59 +1102,180 @@ async def send_heartbeat(writer: asyncio.StreamWriter, interval: int = 30):
             logger.error(f"Error sending heartbeat: {e}")
             break
 
+# Splits the consuming connection into messages: reads up to READ_CHUNK_SIZE bytes at a time and returns every
+# complete line (text) or (frame type, payload) pair (binary) in the buffer, keeping a partial one for the next read.
+# Lines and payloads are memoryviews into one block per read, which is only copied out of the buffer when a
+# partial message has to stay behind.
+class MessageFramer:
+    def __init__(self, reader: asyncio.StreamReader, binary=False, chunk_size=128 * 1024, max_message_size=64_000_000):
+        self.reader = reader
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.max_message_size = max_message_size
+        self.buffer = bytearray()
+        # Leading bytes of the buffer already searched for a newline, so a long line is scanned only once
+        self.scanned = 0
+        self.last_activity = time.monotonic()
+
+    # Next batch of messages; None once the connection closed
+    async def read(self):
+        while True:
+            chunk = await self.reader.read(self.chunk_size)
+            if not chunk:
+                return None
+            self.last_activity = time.monotonic()
+            if self.buffer:
+                self.buffer += chunk
+            else:
+                self.buffer = chunk
+            messages = self._split_frames() if self.binary else self._split_lines()
+            if messages:
+                return messages
+            if len(self.buffer) > self.max_message_size:
+                raise ValueError(f"Message exceeds {self.max_message_size} bytes")
+
+    # The first `end` bytes of the buffer, in a block that is never resized so views into it stay valid
+    def _take(self, end):
+        buffer = self.buffer
+        if end == len(buffer):
+            self.buffer = bytearray()
+            return buffer
+        if isinstance(buffer, bytes):
+            # A chunk read into an empty buffer is shared as is; only the partial message at its end is copied
+            self.buffer = bytearray(memoryview(buffer)[end:])
+            return memoryview(buffer)[:end]
+        block = buffer[:end]
+        del buffer[:end]
+        return block
+
+    # Nothing complete yet: make sure the partial message sits in a buffer the next chunk can extend
+    def _keep_partial(self):
+        if isinstance(self.buffer, bytes):
+            self.buffer = bytearray(self.buffer)
+
+    def _split_lines(self):
+        buffer = self.buffer
+        end = buffer.rfind(b"\n", self.scanned)
+        if end == -1:
+            self.scanned = len(buffer)
+            self._keep_partial()
+            return []
+        spans = []
+        start = 0
+        while start <= end:
+            newline = buffer.find(b"\n", start)
+            spans.append((start, newline))
+            start = newline + 1
+        view = memoryview(self._take(end + 1))
+        # What is left follows the last newline
+        self.scanned = len(self.buffer)
+        return [view[start:stop] for start, stop in spans]
+
+    def _split_frames(self):
+        spans = []
+        buffer = self.buffer
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            frame_type, length = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > self.max_message_size:
+                raise ValueError(f"Frame of {length} bytes exceeds {self.max_message_size} bytes")
+            start = offset + FRAME_HEADER.size
+            if start + length > len(buffer):
+                break
+            spans.append((frame_type, start, start + length))
+            offset = start + length
+        if not offset:
+            self._keep_partial()
+            return []
+        view = memoryview(self._take(offset))
+        return [(frame_type, view[start:end]) for frame_type, start, end in spans]
+
+# One watchdog per connection instead of a timeout on every read: reports idle periods and
+# closes the connection once the receiver is stopping, which ends the read loop
+async def watch_connection(framer: MessageFramer, writer: asyncio.StreamWriter):
+    reported = framer.last_activity
+    while not writer.is_closing():
+        await asyncio.sleep(1.0)
+        if not running:
+            writer.close()
+            return
+        if framer.last_activity > reported:
+            reported = framer.last_activity
+        elif time.monotonic() - reported >= IDLE_REPORT_INTERVAL:
+            logger.debug(f"No messages for {IDLE_REPORT_INTERVAL} seconds")
+            reported = time.monotonic()
+
 # جایگزینی تابع receive_messages
 async def receive_messages(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    global running
-    
-    ack_sender_task = asyncio.create_task(ack_sender_worker(writer))
-    heartbeat_task = asyncio.create_task(send_heartbeat(writer, interval=30))
+    ack_sender_task = None
+    heartbeat_task = None
+    watchdog_task = None
     
     try:
+        features = set()
+        if NEGOTIATE and PROTOCOL_FEATURES and time.monotonic() >= legacy_until:
+            try:
+                features = await negotiate_features(reader, writer, PROTOCOL_FEATURES, HELLO_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                # A late answer to the hello would be read as the reply to the next command, so reconnect
+                mark_legacy_server(f"no answer to hello: {str(e) or 'timed out'}")
+                return
+            if features is None:
+                mark_legacy_server("hello not supported")
+                features = set()
+            else:
+                logger.info(f"Negotiated protocol features: {', '.join(sorted(features)) or 'none'}")
+
         if not await register_public_key(reader, writer):
             logger.error("Public key registration failed")
             return
 
         await configure_server(reader, writer)
+        ssl_context.remember_session(writer)
+
+        binary = "binary_frames" in features and await request_binary_frames(reader, writer)
+        ack_sender_task = asyncio.create_task(ack_sender_worker(writer, binary))
+        heartbeat_task = asyncio.create_task(send_heartbeat(writer, interval=30, binary=binary))
 
         logger.info(f"Subscribing to queue {QUEUE_NAME}")
-        writer.write(f"consume {QUEUE_NAME}\n".encode('utf-8'))
+        command = f"consume {QUEUE_NAME}".encode('utf-8')
+        writer.write(build_frame(FRAME_COMMAND, command) if binary else command + b"\n")
         await writer.drain()
         
-        logger.info(f"Waiting for messages (high-throughput mode)")
+        logger.info(f"Waiting for messages (high-throughput mode, {'binary frames' if binary else 'text'})")
+
+        framer = MessageFramer(reader, binary, READ_CHUNK_SIZE, MAX_MESSAGE_SIZE)
+        watchdog_task = asyncio.create_task(watch_connection(framer, writer))
 
-        consecutive_empty = 0
-        
         while running and not writer.is_closing():
             try:
-                line = await asyncio.wait_for(reader.readline(), timeout=0.5)
-                
-                if not line:
-                    logger.error("Connection closed")
+                messages = await framer.read()
+                if messages is None:
+                    # The watchdog closes the connection on shutdown; anything else is the server going away
+                    if running:
+                        logger.error("Connection closed")
                     break
-                
-                consecutive_empty = 0
-                
-                message = line.decode('utf-8').strip()
-                if not message:
+
+                if binary:
+                    for frame_type, payload in messages:
+                        if frame_type == FRAME_MESSAGE:
+                            await process_frame(payload)
+                        elif frame_type == FRAME_ERROR:
+                            logger.error(f"Server error: {payload.decode('utf-8', 'replace')}")
                     continue
-                
-                await process_message(message)
-                
-            except asyncio.TimeoutError:
-                consecutive_empty += 1
-                if consecutive_empty >= 120:
-                    logger.debug("No messages for 60 seconds")
-                    consecutive_empty = 0
-                continue
+
+                for line in messages:
+                    await process_message(line)
                 
             except Exception as e:
                 logger.error(f"Error in receive loop: {e}")
                 break
                 
     finally:
-        running = False
-        ack_sender_task.cancel()
-        heartbeat_task.cancel()
+        # Only this connection ends here; main() reconnects while the receiver is running
+        for task in (ack_sender_task, heartbeat_task, watchdog_task):
+            if task is not None:
+                task.cancel()
         try:
             writer.close()
             await writer.wait_closed()
@@ -328,34 +1338,58 @@ async def process_messages():
         if message_count > 0:
             logger.info(f"Received {message_count} messages in {end_time - start_time:.2f} seconds")
             logger.info(f"Throughput: {message_count / (end_time - start_time):.2f} messages/second")
+        if latency_tracker.overall.count:
+            logger.info(f"End-to-end latency (overall): {format_latency(latency_tracker.overall.summary())}")
         logger.info("Message processing stopped")
 
-def signal_handler(loop):
+# Periodically log the latency distribution of the last LATENCY_WINDOW seconds
+async def report_latency():
+    while running:
+        await asyncio.sleep(LATENCY_REPORT_INTERVAL)
+        summary = latency_tracker.recent().summary()
+        if summary["count"]:
+            logger.info(f"End-to-end latency (last {LATENCY_WINDOW}s): {format_latency(summary)}")
+
+# Only asks the receiver to stop: the watchdog closes the connection and main() shuts down and returns
+def signal_handler(signum):
     global running
-    logger.info("Received SIGINT, shutting down")
+    logger.info(f"Received {signal.Signals(signum).name}, shutting down")
     running = False
-    loop.call_later(1, loop.stop)
 
 async def main():
-    global message_queue, ack_queue
+    global message_queue, ack_queue, decrypt_executor, decrypt_slots, ssl_context
     
     # Initialize queues in async context
     message_queue = asyncio.Queue()
     ack_queue = asyncio.Queue()
+    decrypt_slots = asyncio.Semaphore(DECRYPT_MAX_IN_FLIGHT)
+    ssl_context = create_ssl_context(TLS_CONFIG)
+    decrypt_executor = create_decrypt_executor()
+    if DEDUP_SNAPSHOT_PATH:
+        load_dedup_snapshot()
+        atexit.register(save_dedup_snapshot)
+    logger.info(f"Decrypting on {DECRYPT_WORKERS} {DECRYPT_EXECUTOR} workers" if decrypt_executor else "Decrypting inline")
     
-    loop = asyncio.get_running_loop()
-    signal.signal(signal.SIGINT, lambda s, f: signal_handler(loop))
+    # The scripts stop clients with plain kill, which sends SIGTERM
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda s, f: signal_handler(s))
     
     processing_task = asyncio.create_task(process_messages())
+    latency_task = asyncio.create_task(report_latency()) if LATENCY_REPORT_INTERVAL > 0 else None
+    snapshot_task = asyncio.create_task(snapshot_dedup()) if DEDUP_SNAPSHOT_PATH and DEDUP_SNAPSHOT_INTERVAL > 0 else None
 
     while running:
         try:
+            started = time.perf_counter()
             reader, writer = await asyncio.open_connection(
                 SERVER_ADDRESS, SERVER_PORT, 
                 ssl=ssl_context, 
                 server_hostname="localhost"
             )
-            logger.info(f"TLS connection established. Cipher: {writer.get_extra_info('cipher')}")
+            elapsed = time.perf_counter() - started
+            resumed = ssl_context.record_handshake(writer, elapsed)
+            logger.info(f"TLS connection established in {elapsed * 1000:.1f} ms "
+                        f"({'resumed session' if resumed else 'full handshake'}). Cipher: {writer.get_extra_info('cipher')}")
             await receive_messages(reader, writer)
         except Exception as e:
             logger.error(f"Connection failed: {e}")
@@ -363,7 +1397,57 @@ async def main():
             if running:
                 await asyncio.sleep(1)
     
+    for task in (latency_task, snapshot_task):
+        if task is not None:
+            task.cancel()
+    # Before waiting for the writer: stop_all.sh force-kills clients that are still up two seconds after SIGTERM
+    save_dedup_snapshot()
     await processing_task
+    if decrypt_executor is not None:
+        decrypt_executor.shutdown(wait=False)
+
+# Compare the byte-level parser with the json.loads one on a generated message: time per message, and the peak
+# memory traced while parsing one, which is what the intermediate copies of the line add up to
+def benchmark_parsing(count, payload_size):
+    session_key = os.urandom(32)
+    nonce = os.urandom(12)
+    ciphertext = ChaCha20Poly1305(session_key).encrypt(nonce, os.urandom(payload_size), None)
+    body = json.dumps({
+        "message_id": "benchmark",
+        "receiver_client_id": CLIENT_ID,
+        "enc_session_key": b64encode(SealedBox(PRIVATE_KEY.public_key).encrypt(session_key)).decode('ascii'),
+        "nonce": b64encode(nonce).decode('ascii'),
+        "ciphertext": b64encode(ciphertext).decode('ascii'),
+        "sent_time": datetime.now(timezone.utc).isoformat(),
+        "sent_timestamp": datetime.now(timezone.utc).timestamp()
+    })
+    line = memoryview(f"Message: benchmark {body}".encode('utf-8'))
+    results = {"messages": count, "payload_size": payload_size, "line_size": len(line)}
+    for name, parse in (("json", parse_text_message_json), ("bytes", parse_text_message)):
+        if parse(line)[1]["ciphertext"] != ciphertext:
+            raise AssertionError(f"{name} parser returned the wrong ciphertext")
+        started = time.perf_counter()
+        for _ in range(count):
+            parse(line)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        parse(line)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        results[name] = {"us_per_message": round(elapsed / count * 1e6, 2), "peak_bytes_per_message": peak}
+    print(json.dumps(results, indent=2))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="CipherMQ receiver")
+    parser.add_argument("--benchmark-parse", type=int, metavar="MESSAGES",
+                        help="time the text message parsers on MESSAGES generated messages and exit")
+    parser.add_argument("--payload-size", type=int, default=4096, help="plaintext size for --benchmark-parse")
+    args = parser.parse_args()
+    load_settings()
+    if args.benchmark_parse:
+        benchmark_parsing(args.benchmark_parse, args.payload_size)
+    else:
+        asyncio.run(main())
\ No newline at end of file
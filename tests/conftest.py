@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The demos ship identical copies of the client scripts; test the multi-client ones
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIR = os.path.join(ROOT, "CipherMQ-Demo_MultiClient_windows-x86_64", "client")
+sys.path.insert(0, os.path.join(CLIENT_DIR, "sender_1"))
+sys.path.insert(0, os.path.join(CLIENT_DIR, "receiver_1"))
+
+
+# The receiver learns its client id from its certificate in load_settings(); the parsers only need the id
+@pytest.fixture
+def receiver_identity(monkeypatch):
+    import Receiver
+    monkeypatch.setattr(Receiver, "CLIENT_ID", "receiver_1", raising=False)
+    monkeypatch.setattr(Receiver, "CLIENT_ID_BYTES", b"receiver_1", raising=False)
+    return "receiver_1"
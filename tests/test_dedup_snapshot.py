@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+import Receiver
+
+
+def test_snapshot_round_trip():
+    index = Receiver.DedupIndex(window=3600, slots=4, max_ids=1000)
+    for number in range(300):
+        index.add(f"sender_1-{number:08x}-receiver_1")
+
+    restored = Receiver.DedupIndex(window=3600, slots=4, max_ids=1000)
+    restored.restore(index.snapshot())
+
+    assert len(restored) == 300
+    assert all(f"sender_1-{number:08x}-receiver_1" in restored for number in range(300))
+    assert "sender_1-ffffffff-receiver_1" not in restored
+    assert [ids for _, ids in restored.slots] == [ids for _, ids in index.slots]
+    assert not restored.dirty
+
+
+def test_snapshot_round_trip_with_bloom_filters():
+    # Ten ids per slot, so most ids move into the Bloom filters
+    index = Receiver.DedupIndex(window=3600, slots=10, max_ids=100, bloom_capacity=500)
+    for number in range(400):
+        index.add(f"m{number}")
+    assert index.blooms
+
+    restored = Receiver.DedupIndex(window=3600, slots=10, max_ids=100, bloom_capacity=500)
+    restored.restore(index.snapshot())
+
+    assert all(f"m{number}" in restored for number in range(400))
+    assert [bloom.bits for bloom in restored.blooms] == [bloom.bits for bloom in index.blooms]
+    assert [bloom.count for bloom in restored.blooms] == [bloom.count for bloom in index.blooms]
+
+
+def test_restore_ignores_filters_built_with_other_settings():
+    index = Receiver.DedupIndex(window=3600, slots=10, max_ids=100, bloom_capacity=500)
+    for number in range(400):
+        index.add(f"m{number}")
+
+    restored = Receiver.DedupIndex(window=3600, slots=10, max_ids=100, bloom_capacity=5000)
+    restored.restore(index.snapshot())
+
+    assert not restored.blooms
+    assert len(restored) == len(index)
+
+
+def test_snapshot_state_is_unaffected_by_later_adds():
+    index = Receiver.DedupIndex(window=3600, slots=4, max_ids=1000)
+    index.add("before")
+    slots, _ = index.snapshot_state()
+    assert not index.dirty
+    index.add("after")
+
+    assert slots[-1][1] == {"before"}
+    assert index.dirty
+
+
+def test_restore_drops_expired_slots():
+    now = time.time()
+    data = Receiver.encode_dedup_snapshot([(now - 7200, {"old"}), (now - 10, {"new", "newer"})], [])
+
+    index = Receiver.DedupIndex(window=3600, slots=4)
+    index.restore(data)
+
+    assert "old" not in index
+    assert "new" in index and "newer" in index
+    assert len(index) == 2
+
+
+def test_encode_decode_keeps_empty_slots():
+    slots = [(1.5, set()), (2.5, {"a", "b"})]
+    blooms = [(64, 3, 2, bytes(range(8)))]
+
+    assert Receiver.decode_dedup_snapshot(Receiver.encode_dedup_snapshot(slots, blooms)) == (slots, blooms)
+
+
+def test_unknown_snapshot_format_is_rejected():
+    data = Receiver.encode_dedup_snapshot([(1.0, {"a"})], [])
+
+    with pytest.raises(ValueError):
+        Receiver.decode_dedup_snapshot(b"XXXX" + data[4:])
+
+
+def test_corrupt_snapshot_is_rejected():
+    header = Receiver.DEDUP_SNAPSHOT_HEADER.pack(Receiver.DEDUP_SNAPSHOT_MAGIC, Receiver.DEDUP_SNAPSHOT_VERSION, 1, 0)
+    ids = b"a\nb"
+    data = header + Receiver.DEDUP_SLOT_HEADER.pack(1.0, 3, len(ids)) + ids
+
+    with pytest.raises(ValueError, match="Corrupt"):
+        Receiver.decode_dedup_snapshot(data)
@@ -0,0 +1,88 @@
+import asyncio
+import random
+
+import pytest
+
+import Receiver
+
+
+# Hands out the stream in the given chunks, then EOF
+class ChunkedReader:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, size):
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= size
+        return chunk
+
+
+def random_chunks(data, rng, chunk_size):
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, chunk_size)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+# Everything the framer returns before EOF; the views are kept until the end, so they must stay valid
+def read_all(framer):
+    async def run():
+        received = []
+        while (messages := await framer.read()) is not None:
+            received.extend(messages)
+        return received
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_lines_survive_random_chunking(seed):
+    rng = random.Random(seed)
+    lines = [rng.randbytes(rng.choice([0, 1, 10, 500, 3000])).replace(b"\n", b" ") for _ in range(200)]
+    data = b"".join(line + b"\n" for line in lines)
+    chunk_size = rng.choice([3, 7, 64, 4096])
+
+    framer = Receiver.MessageFramer(ChunkedReader(random_chunks(data, rng, chunk_size)), chunk_size=chunk_size)
+    received = read_all(framer)
+
+    assert [bytes(line) for line in received] == lines
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_frames_survive_random_chunking(seed):
+    rng = random.Random(seed)
+    frames = [(rng.choice([Receiver.FRAME_MESSAGE, Receiver.FRAME_ERROR]), rng.randbytes(rng.choice([0, 3, 300, 3000])))
+              for _ in range(200)]
+    data = b"".join(Receiver.build_frame(frame_type, payload) for frame_type, payload in frames)
+    chunk_size = rng.choice([3, 5, 64, 4096])
+
+    framer = Receiver.MessageFramer(ChunkedReader(random_chunks(data, rng, chunk_size)), binary=True,
+                                    chunk_size=chunk_size)
+    received = read_all(framer)
+
+    assert [(frame_type, bytes(payload)) for frame_type, payload in received] == frames
+
+
+def test_partial_line_at_eof_is_dropped():
+    framer = Receiver.MessageFramer(ChunkedReader([b"complete\npart"]))
+
+    assert [bytes(line) for line in read_all(framer)] == [b"complete"]
+
+
+def test_oversized_line_is_rejected():
+    framer = Receiver.MessageFramer(ChunkedReader([b"x" * 64] * 4), chunk_size=64, max_message_size=100)
+
+    with pytest.raises(ValueError):
+        read_all(framer)
+
+
+def test_oversized_frame_is_rejected():
+    frame = Receiver.build_frame(Receiver.FRAME_MESSAGE, b"x" * 200)
+    framer = Receiver.MessageFramer(ChunkedReader([frame]), binary=True, chunk_size=4096, max_message_size=100)
+
+    with pytest.raises(ValueError):
+        read_all(framer)
@@ -0,0 +1,112 @@
+import asyncio
+
+import Sender
+
+
+def message(number, size=0):
+    return {"message_id": f"m{number}", "ciphertext": b"x" * size}
+
+
+def test_reject_policy_refuses_past_max_messages():
+    async def run():
+        store = Sender.PendingStore(max_messages=2, policy="reject")
+        added = [await store.add(message(number)) for number in range(3)]
+        return store, added
+
+    store, added = asyncio.run(run())
+    assert added == [True, True, False]
+    assert len(store) == 2 and "m2" not in store
+    assert store.stats()["refused"] == 1
+
+
+def test_reject_policy_refuses_past_max_bytes():
+    size = Sender.PendingStore.message_size(message(0, 1000))
+
+    async def run():
+        store = Sender.PendingStore(max_bytes=2 * size, policy="reject")
+        added = [await store.add(message(number, 1000)) for number in range(3)]
+        return store, added
+
+    store, added = asyncio.run(run())
+    assert added == [True, True, False]
+    assert store.stats()["bytes"] == 2 * size
+
+
+def test_ack_frees_room():
+    async def run():
+        store = Sender.PendingStore(max_messages=1, policy="reject")
+        await store.add(message(0))
+        store.ack("m0")
+        return store, await store.add(message(1))
+
+    store, added = asyncio.run(run())
+    assert added
+    assert store.stats()["acked"] == 1 and store.stats()["bytes"] == store.message_size(message(1))
+
+
+def test_block_policy_waits_for_an_ack():
+    async def run():
+        store = Sender.PendingStore(max_messages=1, policy="block")
+        await store.add(message(0))
+        blocked = asyncio.create_task(store.add(message(1)))
+        await asyncio.sleep(0.01)
+        waited = not blocked.done()
+        store.ack("m0")
+        return store, waited, await asyncio.wait_for(blocked, 1)
+
+    store, waited, added = asyncio.run(run())
+    assert waited and added
+    assert "m1" in store
+    assert store.stats()["blocked"] == 1
+
+
+# With nothing in flight no ack can ever free room, so blocking would wait forever
+def test_block_policy_refuses_what_can_never_fit():
+    async def run():
+        store = Sender.PendingStore(max_bytes=100, policy="block")
+        return store, await store.add(message(0, 1000))
+
+    store, added = asyncio.run(run())
+    assert not added
+    assert store.stats()["refused"] == 1
+
+
+def test_failed_messages_are_evicted_for_new_ones():
+    async def run():
+        store = Sender.PendingStore(max_messages=2, policy="reject")
+        await store.add(message(0))
+        await store.add(message(1))
+        store.fail("m0")
+        return store, await store.add(message(2))
+
+    store, added = asyncio.run(run())
+    assert added
+    assert store.failed_messages() == []
+    assert store.stats()["evicted"] == 1 and store.stats()["failed"] == 1
+
+
+def test_failed_messages_expire():
+    async def run():
+        store = Sender.PendingStore(max_messages=10, failed_ttl=0)
+        await store.add(message(0))
+        store.fail("m0")
+        return store
+
+    store = asyncio.run(run())
+    assert store.failed_messages() == []
+    assert store.stats()["expired"] == 1 and store.stats()["bytes"] == 0
+
+
+def test_failed_messages_are_kept_until_acked():
+    async def run():
+        store = Sender.PendingStore(max_messages=10)
+        await store.add(message(0))
+        store.fail("m0")
+        held = store.failed_messages()
+        store.ack("m0")
+        return store, held
+
+    store, held = asyncio.run(run())
+    assert held == [message(0)]
+    assert store.failed_messages() == []
+    assert store.stats()["bytes"] == 0
@@ -0,0 +1,150 @@
+import asyncio
+
+import Sender
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(data)
+
+    async def drain(self):
+        pass
+
+
+class NoPacing:
+    def record_error(self, *args):
+        pass
+
+    def record_ack(self, *args):
+        pass
+
+
+def message(number):
+    return {"message_id": f"m{number}", "routing_key": "rk", "receiver_client_id": "receiver_1",
+            "ciphertext": b"ciphertext", "nonce": b"n" * 12, "enc_session_key": b"k" * 80, "sent_time": ""}
+
+
+def open_window(retries, timeout=1.0):
+    reader = asyncio.StreamReader()
+    writer = RecordingWriter()
+    acked = []
+    window = Sender.PublishWindow(reader, writer, "ex", acked.append, NoPacing(), retries, window_size=8,
+                                  timeout=timeout)
+    window.start()
+    return window, reader, writer, acked
+
+
+def test_ack_resolves_the_publish():
+    async def run():
+        window, reader, writer, acked = open_window(Sender.RetryScheduler(3, 0.01, 0.01, 10))
+        outcome = await window.submit(message(1))
+        await asyncio.sleep(0)
+        reader.feed_data(b"ACK m1\n")
+        result = await asyncio.wait_for(outcome, 1)
+        await window.close()
+        return result, acked, writer.sent
+
+    result, acked, sent = asyncio.run(run())
+    assert result is True
+    assert acked == ["m1"]
+    assert len(sent) == 1
+
+
+# Errors carry no message_id, so they belong to the oldest publish still owed a reply
+def test_error_fails_the_oldest_unanswered_publish():
+    async def run():
+        window, reader, _, _ = open_window(Sender.RetryScheduler(1, 0.01, 0.01, 10))
+        first = await window.submit(message(1))
+        second = await window.submit(message(2))
+        await asyncio.sleep(0)
+        reader.feed_data(b"Error: rejected\n")
+        reader.feed_data(b"ACK m2\n")
+        results = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        await window.close()
+        return results
+
+    assert asyncio.run(run()) == [False, True]
+
+
+def test_late_error_goes_to_the_timed_out_publish():
+    async def run():
+        # m1 times out and waits for a retry that is not due before the late error arrives
+        window, reader, _, _ = open_window(Sender.RetryScheduler(3, 5, 5, 60), timeout=0.05)
+        first = await window.submit(message(1))
+        await asyncio.sleep(0.1)
+        second = await window.submit(message(2))
+        await asyncio.sleep(0)
+        reader.feed_data(b"Error: rejected\n")
+        reader.feed_data(b"ACK m2\n")
+        results = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        await window.close()
+        return results
+
+    assert asyncio.run(run()) == [False, True]
+
+
+def test_timed_out_publish_is_retried():
+    async def run():
+        window, reader, writer, _ = open_window(Sender.RetryScheduler(3, 0.01, 0.01, 10), timeout=0.05)
+        outcome = await window.submit(message(1))
+        while len(writer.sent) < 2:
+            await asyncio.sleep(0.01)
+        reader.feed_data(b"ACK m1\n")
+        result = await asyncio.wait_for(outcome, 1)
+        await window.close()
+        return result, writer.sent
+
+    result, sent = asyncio.run(run())
+    assert result is True
+    assert len(sent) == 2 and sent[0] == sent[1]
+
+
+def test_publish_fails_after_max_attempts():
+    async def run():
+        window, _, writer, _ = open_window(Sender.RetryScheduler(2, 0.01, 0.01, 10), timeout=0.05)
+        outcome = await window.submit(message(1))
+        result = await asyncio.wait_for(outcome, 2)
+        await window.close()
+        return result, writer.sent
+
+    result, sent = asyncio.run(run())
+    assert result is False
+    assert len(sent) == 2
+
+
+def test_backoff_uses_equal_jitter_up_to_the_cap():
+    retries = Sender.RetryScheduler(10, base_delay=0.5, max_delay=4.0)
+
+    for attempt, delay in [(1, 0.5), (2, 1.0), (3, 2.0), (4, 4.0), (8, 4.0)]:
+        for _ in range(50):
+            assert delay / 2 <= retries.backoff(attempt) <= delay
+
+
+def test_scheduled_callbacks_run_in_due_order():
+    async def run():
+        retries = Sender.RetryScheduler()
+        fired = []
+        for name, delay in [("c", 0.03), ("a", 0.01), ("b", 0.02), ("a2", 0.01)]:
+            retries.schedule(delay, fired.append, name)
+        pending = len(retries)
+        await asyncio.sleep(0.1)
+        return fired, pending, len(retries)
+
+    fired, pending, left = asyncio.run(run())
+    assert fired == ["a", "a2", "b", "c"]
+    assert (pending, left) == (4, 0)
+
+
+def test_close_drops_scheduled_callbacks():
+    async def run():
+        retries = Sender.RetryScheduler()
+        fired = []
+        retries.schedule(0.01, fired.append, "never")
+        retries.close()
+        await asyncio.sleep(0.05)
+        return fired, len(retries)
+
+    assert asyncio.run(run()) == ([], 0)
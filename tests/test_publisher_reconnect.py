@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+
+from Sender import CipherMQProducer, PublisherPool
+
+
+# Plain TCP stand-in for the server: answers every publish with an ACK and can be restarted on the same port
+class FakeBroker:
+    def __init__(self):
+        self.server = None
+        self.port = 0
+        self.writers = set()
+        self.connections = 0
+        self.received = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.transport.abort()
+        await self.server.wait_closed()
+
+    async def restart(self, downtime):
+        await self.stop()
+        await asyncio.sleep(downtime)
+        await self.start()
+
+    async def _handle(self, reader, writer):
+        self.writers.add(writer)
+        self.connections += 1
+        try:
+            while line := await reader.readline():
+                # publish <exchange> <routing_key> <json>
+                parts = line.decode("utf-8").rstrip("\n").split(" ", 3)
+                if parts[0] == "publish":
+                    message_id = json.loads(parts[3])["message_id"]
+                    self.received.append(message_id)
+                    writer.write(f"ACK {message_id}\n".encode("utf-8"))
+                    await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.writers.discard(writer)
+
+
+def make_producer(port):
+    config = {
+        "exchange_name": "test_exchange",
+        "server_address": "127.0.0.1",
+        "server_port": port,
+        "tls": {},
+        "publish": {"window_size": 8, "max_retries": 3, "ack_timeout": 2,
+                    "retry_base_delay_ms": 20, "retry_max_delay_ms": 100, "delivery_deadline": 30},
+        "pacing": {"enabled": False},
+    }
+    producer = CipherMQProducer(config, client_id="sender_test")
+
+    async def open_connection(purpose, timeout=10.0):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        return reader, writer, set()
+
+    producer.open_connection = open_connection
+    return producer
+
+
+def make_message(number):
+    return {
+        "message_id": f"msg-{number}",
+        "routing_key": "rk",
+        "receiver_client_id": "receiver_1",
+        "ciphertext": os.urandom(32),
+        "nonce": os.urandom(12),
+        "enc_session_key": os.urandom(48),
+        "sent_time": "2026-01-01T00:00:00Z",
+    }
+
+
+def test_messages_survive_broker_restart():
+    async def scenario():
+        broker = FakeBroker()
+        await broker.start()
+        producer = make_producer(broker.port)
+        pool = PublisherPool(producer, 1)
+        await pool.open()
+        try:
+            results = []
+            for number in range(200):
+                results.append(await pool.dispatch(make_message(number)))
+                if number == 100:
+                    await broker.restart(0.2)
+            outcomes = await asyncio.wait_for(asyncio.gather(*results), 20)
+            failed = await pool.flush()
+        finally:
+            await pool.close()
+            await broker.stop()
+        return outcomes, failed, broker
+
+    outcomes, failed, broker = asyncio.run(scenario())
+    assert broker.connections == 2
+    assert all(outcomes)
+    assert failed == []
+    assert set(broker.received) == {f"msg-{number}" for number in range(200)}
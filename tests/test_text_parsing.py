@@ -0,0 +1,105 @@
+import json
+import os
+from base64 import b64encode
+
+import pytest
+
+import Receiver
+import Sender
+
+
+def encrypted_message(**extra):
+    message = {
+        "message_id": "sender_1-0a1b2c3d-receiver_1",
+        "routing_key": "receiver_1_key",
+        "receiver_client_id": "receiver_1",
+        "ciphertext": os.urandom(1000),
+        "nonce": os.urandom(12),
+        "enc_session_key": os.urandom(80),
+        "sent_time": "2026-01-01T00:00:00+00:00",
+    }
+    message.update(extra)
+    return message
+
+
+# The server delivers a publish to consumers as "Message: <id> <json>"
+def message_line(payload, message_id="sender_1-0a1b2c3d-receiver_1"):
+    return f"Message: {message_id} {payload}\n".encode("utf-8")
+
+
+def published_line(message):
+    command = Sender.build_publish_command(message, "ciphermq_exchange").decode("utf-8")
+    return message_line(command.rstrip("\n").split(" ", 3)[3], message["message_id"])
+
+
+CASES = {
+    "plain": encrypted_message(),
+    "optional fields": encrypted_message(sent_timestamp=1767225600.125, key_id="00112233aabbccdd",
+                                         compression="zstd", compression_dict="0a1b2c3d"),
+    "recipients": encrypted_message(recipients={"receiver_2": os.urandom(80), "receiver_1": os.urandom(80)}),
+    "other recipients": encrypted_message(recipients={"receiver_2": os.urandom(80)}),
+    "no recipients": encrypted_message(recipients={}),
+}
+
+
+@pytest.mark.parametrize("message", CASES.values(), ids=CASES.keys())
+def test_byte_parser_matches_json_parser(receiver_identity, message):
+    line = published_line(message)
+
+    assert Receiver.parse_text_message(line) == Receiver.parse_text_message_json(line)
+
+
+def test_byte_parser_decodes_fields(receiver_identity):
+    recipients = {"receiver_2": os.urandom(80), "receiver_1": os.urandom(80)}
+    message = encrypted_message(recipients=recipients, sent_timestamp=1767225600.5)
+
+    message_id, fields = Receiver.parse_text_message(published_line(message))
+
+    assert message_id == message["message_id"]
+    assert fields["ciphertext"] == message["ciphertext"]
+    assert fields["nonce"] == message["nonce"]
+    assert fields["enc_session_key"] == recipients["receiver_1"]
+    assert fields["sent_timestamp"] == 1767225600.5
+
+
+# Slices of the read buffer reach the parsers as memoryviews
+def test_parsers_accept_memoryviews(receiver_identity):
+    line = published_line(encrypted_message(key_id="00112233aabbccdd"))
+    view = memoryview(bytearray(b"padding" + line))[len(b"padding"):]
+
+    assert Receiver.parse_text_message(view) == Receiver.parse_text_message_json(line)
+    assert Receiver.parse_text_message_json(view) == Receiver.parse_text_message_json(line)
+
+
+def test_layout_and_escapes_match_json_parser(receiver_identity):
+    message = encrypted_message()
+    payload = {
+        "message_id": message["message_id"],
+        "nonce": b64encode(message["nonce"]).decode("ascii"),
+        "enc_session_key": b64encode(message["enc_session_key"]).decode("ascii"),
+        "ciphertext": b64encode(message["ciphertext"]).decode("ascii"),
+        "key_id": None,
+        "compression_dict": "0a1b\\u0032c3d",
+        "sent_timestamp": -1.5e3,
+    }
+    # Spaced out, with a value the byte parser hands to json.loads
+    raw = json.dumps(payload, indent=2).replace("\\\\u0032", "\\u0032").replace("\n", " ")
+    line = message_line(raw)
+
+    message_id, fields = Receiver.parse_text_message(line)
+    assert (message_id, fields) == Receiver.parse_text_message_json(line)
+    assert fields["compression_dict"] == "0a1b2c3d"
+    assert fields["key_id"] is None
+    assert fields["sent_timestamp"] == -1500.0
+
+
+def test_missing_fields_are_rejected(receiver_identity):
+    line = message_line(json.dumps({"ciphertext": "AAAA", "enc_session_key": "AAAA"}))
+
+    with pytest.raises(ValueError):
+        Receiver.parse_text_message(line)
+
+
+def test_line_without_id_is_rejected(receiver_identity):
+    with pytest.raises(ValueError):
+        Receiver.parse_text_message(b"Message:\n")
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+import Receiver
+import Sender
+
+
+def encrypted_message(**extra):
+    message = {
+        "message_id": "sender_1-0a1b2c3d-receiver_1",
+        "routing_key": "receiver_1_key",
+        "receiver_client_id": "receiver_1",
+        "ciphertext": os.urandom(300),
+        "nonce": os.urandom(12),
+        "enc_session_key": os.urandom(80),
+        "sent_time": "2026-01-01T00:00:00+00:00",
+    }
+    message.update(extra)
+    return message
+
+
+# The server forwards the envelope of a publish frame to consumers as is
+def envelope_of(frame):
+    frame_type, length = Sender.FRAME_HEADER.unpack_from(frame)
+    assert frame_type == Sender.FRAME_PUBLISH
+    payload = frame[Sender.FRAME_HEADER.size:]
+    assert len(payload) == length
+    exchange_length = payload[0]
+    exchange = payload[1:1 + exchange_length]
+    routing_key_length = payload[1 + exchange_length]
+    offset = 2 + exchange_length
+    routing_key = payload[offset:offset + routing_key_length]
+    return exchange, routing_key, payload[offset + routing_key_length:]
+
+
+def test_publish_frame_round_trip(receiver_identity):
+    message = encrypted_message(sent_timestamp=1767225600.25, key_id="00112233aabbccdd",
+                                compression="zlib", compression_dict="0a1b2c3d")
+    exchange, routing_key, envelope = envelope_of(Sender.build_publish_frame(message, "ciphermq_exchange"))
+
+    assert exchange == b"ciphermq_exchange"
+    assert routing_key == b"receiver_1_key"
+    message_id, fields = Receiver.decode_envelope(envelope)
+    assert message_id == message["message_id"]
+    assert fields["nonce"] == message["nonce"]
+    assert bytes(fields["ciphertext"]) == message["ciphertext"]
+    assert fields["enc_session_key"] == message["enc_session_key"]
+    assert fields["key_id"] == "00112233aabbccdd"
+    assert fields["compression"] == "zlib"
+    assert fields["compression_dict"] == "0a1b2c3d"
+    assert fields["sent_timestamp"] == 1767225600.25
+
+
+def test_envelope_without_optional_fields(receiver_identity):
+    _, _, envelope = envelope_of(Sender.build_publish_frame(encrypted_message(), "ex"))
+
+    _, fields = Receiver.decode_envelope(envelope)
+    assert fields["key_id"] is None
+    assert fields["compression"] is None
+    assert fields["compression_dict"] is None
+    assert fields["sent_timestamp"] is None
+
+
+def test_envelope_picks_this_receivers_sealed_key(receiver_identity):
+    recipients = {"receiver_2": os.urandom(80), "receiver_1": os.urandom(80), "receiver_3": os.urandom(80)}
+    _, _, envelope = envelope_of(Sender.build_publish_frame(encrypted_message(recipients=recipients), "ex"))
+
+    _, fields = Receiver.decode_envelope(envelope)
+    assert fields["enc_session_key"] == recipients["receiver_1"]
+
+
+def test_envelope_for_other_recipients_has_no_key(receiver_identity):
+    recipients = {"receiver_2": os.urandom(80)}
+    message = encrypted_message(recipients=recipients)
+    _, _, envelope = envelope_of(Sender.build_publish_frame(message, "ex"))
+
+    _, fields = Receiver.decode_envelope(envelope)
+    assert fields["enc_session_key"] is None
+    assert bytes(fields["ciphertext"]) == message["ciphertext"]
+
+
+def test_truncated_envelope_is_rejected(receiver_identity):
+    _, _, envelope = envelope_of(Sender.build_publish_frame(encrypted_message(), "ex"))
+
+    with pytest.raises(ValueError, match="Truncated"):
+        Receiver.decode_envelope(envelope[:-1])
+
+
+def test_unknown_envelope_version_is_rejected(receiver_identity):
+    _, _, envelope = envelope_of(Sender.build_publish_frame(encrypted_message(), "ex"))
+
+    with pytest.raises(ValueError, match="version"):
+        Receiver.decode_envelope(bytes([Sender.ENVELOPE_VERSION + 1]) + envelope[1:])
+
+
+def test_build_frame_matches_frame_header():
+    frame = Receiver.build_frame(Receiver.FRAME_ACK, b"message-1")
+
+    assert Receiver.FRAME_HEADER.unpack_from(frame) == (Receiver.FRAME_ACK, len(b"message-1"))
+    assert frame[Receiver.FRAME_HEADER.size:] == b"message-1"